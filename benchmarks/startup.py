@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# Measures the startup latency of ct --help and ct run true, and appends the results to a history file, so that
+# regressions are easy to spot. Run it from a project directory with a cluster config:
+#   python <path to cluster_tool>/benchmarks/startup.py [-n repeats] [-m hosts] [--history file]
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from src.utils import get_cache_dir
+
+
+def measure(args, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        subprocess.run([sys.executable, os.path.join(ROOT, "main.py")] + args, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL)
+        times.append(time.time() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def get_commit():
+    proc = subprocess.run(["git", "-C", ROOT, "rev-parse", "--short", "HEAD"], stdout=subprocess.PIPE,
+                          stderr=subprocess.DEVNULL)
+    return proc.stdout.decode().strip() or None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the startup time of ct')
+    parser.add_argument('-n', '--repeats', type=int, default=5, help="Number of measurements (the median is used)")
+    parser.add_argument('-m', '--hosts', type=str, help="Hosts for ct run true")
+    parser.add_argument('--history', type=str, default=os.path.join(get_cache_dir(), "startup_history.jsonl"),
+                        help="Append the results to this file")
+    args = parser.parse_args()
+
+    host_args = ["-m", args.hosts] if args.hosts else []
+    res = {
+        "time": time.time(),
+        "commit": get_commit(),
+        "help": measure(["--help"], args.repeats),
+        "run_true": measure(host_args + ["run", "true"], args.repeats),
+    }
+
+    previous = None
+    if os.path.isfile(args.history):
+        with open(args.history) as f:
+            lines = [l for l in f.read().split("\n") if l.strip()]
+            previous = json.loads(lines[-1]) if lines else None
+
+    for name in ["help", "run_true"]:
+        line = f"ct {name.replace('_', ' ')}: {res[name]:.3f}s"
+        if previous is not None and name in previous:
+            line += f" (previous: {previous[name]:.3f}s at {previous.get('commit')})"
+        print(line)
+
+    with open(args.history, "a") as f:
+        f.write(json.dumps(res) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# Compares syncing the project and its sync.extra paths root by root (the old way: mkdir and rsync per root) with
+# the batched sync. Run it from the project directory:
+#   python <path to cluster_tool>/benchmarks/sync_roots.py <host> [repeats]
+import os
+import sys
+import time
+import shlex
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from src.config import config
+from src.process_tools import remote_run, run_process
+from src.ssh_pool import connection_pool
+from src import sync
+from src import cache
+from src.utils import quote_remote_path
+
+
+def sync_per_root(host, roots, exclude, ignore_files):
+    filter_args = sync.get_filter_args(exclude, ignore_files)
+    for src, dest in roots:
+        dest = quote_remote_path(dest.strip())
+        remote_run(host, "mkdir -p " + dest)
+        # The flags of the original sync. Without -t, every file goes through the delta transfer on every run.
+        run_process("rsync -r --delete" + connection_pool.get_rsync_flags(host) + shlex.quote(src) + filter_args +
+                    " " + host + ":" + dest)
+
+
+def measure(name, fn, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+        sync.local_manifests.clear()
+    print(f"{name}: best {min(times):.2f}s, mean {sum(times)/len(times):.2f}s")
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(f"Usage: {sys.argv[0]} <host> [repeats]")
+        sys.exit(1)
+
+    host = sys.argv[1]
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    roots = sync.get_sync_list()
+    exclude, ignore_files = sync.get_sync_filters()
+    print(f"Syncing {len(roots)} roots to {host}")
+
+    # Open the persistent connection, so that both variants get the same handshake cost.
+    connection_pool.connect(config.get_data_transfer_node(host))
+
+    measure("Per root", lambda: sync_per_root(host, roots, exclude, ignore_files), repeats)
+
+    cache.REFRESH = True
+    measure("Batched, unknown remote state", lambda: sync.sync_many(host, roots, exclude, ignore_files), repeats)
+    cache.REFRESH = False
+
+    sync.sync_many(host, roots, exclude, ignore_files)
+    measure("Batched, nothing changed", lambda: sync.sync_many(host, roots, exclude, ignore_files), repeats)
+
+    def touch_and_sync():
+        for f in os.listdir(roots[0][0]):
+            if os.path.isfile(os.path.join(roots[0][0], f)):
+                os.utime(os.path.join(roots[0][0], f))
+                break
+        sync.sync_many(host, roots, exclude, ignore_files)
+
+    measure("Batched, one file changed", touch_and_sync, repeats)
+
+
+if __name__ == "__main__":
+    main()
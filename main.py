@@ -4,18 +4,22 @@ from src.detect_gpus import get_free_gpu_list
 from src.remote_process import kill_pids, find_phantom_processes, kill_phantom_processes
 import argparse
 import src.process_tools
-from src.process_tools import run_multiple_on_multiple, run_multiple_hosts
+import src.cache
+from src.process_tools import run_multiple_on_multiple, run_multiple_hosts, iter_multiple_hosts, stream_multiple_hosts, \
+    TIMEOUT_ERRCODE
 from src.sync import sync_curr_dir_multiple, gather_relative, copy_local_dir
+from src.watch import watch_and_sync
 import sys
 from src.config import config
 from src.setup import do_setup
 from src.ssh_setup import setup_ssh_login
 from src.screen import run_in_screen, is_screen_running
 from src.utils import expand_args
+from src.ssh_pool import connection_pool
 from src import slurm
-from src import wandb_interface
 import getpass
 import os
+import time
 
 parser = argparse.ArgumentParser(description='Run on cluster')
 parser.add_argument('args', metavar='N', type=str, nargs='*', help='switch dependet args')
@@ -29,6 +33,7 @@ parser.add_argument('-n', '--name', type=str, help="Name for training")
 parser.add_argument('-d', '--debug', default=False, action='store_true', help="Debug: display all the shell commands")
 parser.add_argument('-c', '--count', type=int, help="count for wandb sweep")
 parser.add_argument('-pg', '--per_gpu', type=int, default=1, help="W&B agents per GPU")
+parser.add_argument('-rpt', '--runs_per_task', type=int, default=1, help="SLURM: do this many runs one after the other in a single task (per W&B agent), if they fit in the runtime")
 parser.add_argument('-mgpu', '--multi_gpu', type=int, default=1, help="Use this many GPUs per run")
 parser.add_argument('-p', '--project', default="", help="Overwrite wandb project from the config file")
 parser.add_argument('-s', '--slurm', default=False, action='store_true', help="Enable SLURM operations. Prevents accidental runs.")
@@ -37,21 +42,33 @@ parser.add_argument('-f', '--force', default=False, action='store_true', help="F
 parser.add_argument('-ff', '--force2', default=False, action='store_true', help="Continue training of 'running' runs. Needed when W&B does not detect the crash.")
 parser.add_argument('-FGPU', '--force_gpus', default=False, action='store_true', help="Force using the GPUs even if overallocating someone")
 parser.add_argument('-gt', '--gpu_type', default="", help="Allocate specific GPU types")
+parser.add_argument('-pl', '--placement', default="", help="How to place runs on the GPUs of SSH hosts: pack (fill the best hosts first) or spread (distribute evenly)")
 parser.add_argument('-sp', '--slurm_partition', default="", help="Which slurm partition to use")
 parser.add_argument('-ncpu', '--num_cpus', default="", help="How many CPUs to allocate per GPU")
 parser.add_argument('-mem', '--memory', default="", help="How many RAM to allocate per GPU")
+parser.add_argument('-to', '--timeout', type=float, help="Kill remote commands running longer than this many seconds on a host")
+parser.add_argument('-dl', '--deadline', type=float, help="Stop waiting for hosts after this many seconds and show the partial results")
+parser.add_argument('-st', '--stream', default=False, action='store_true', help="Print the output of run/sudo line by line as it arrives, prefixed by the host name")
+parser.add_argument('--tee', type=str, help="Stream the output and also save the full output of each host to <dir>/<host>.log")
+parser.add_argument('-w', '--watch', default=False, action='store_true', help="Keep syncing the current directory on every change")
+parser.add_argument('--prune', default=False, action='store_true', help="Delete the gathered files which were deleted from the hosts")
+parser.add_argument('--refresh', default=False, action='store_true', help="Ignore the cached information about the hosts and query them again")
 parser.add_argument('-e', '--exclude_machines', default="", help="Exclude machine from the SLURM machine list. Can be a list")
 
 args = parser.parse_args()
 
 src.process_tools.DEBUG = args.debug
+src.cache.REFRESH = args.refresh
 exclude_machines = set(s.strip() for s in args.exclude_machines.split(","))
 
 config.set_args(args)
 if args.project:
     config.update({"wandb": {"project": args.project}})
+if args.placement:
+    config.update({"placement": {"policy": args.placement}})
 
-slurm.update_slurm_authentication()
+if args.args:
+    slurm.update_slurm_authentication(config.get_all_hosts())
 
 def assert_arg_count(cnt, print_usage = lambda: None):
     if len(args.args)-1 != cnt:
@@ -62,15 +79,40 @@ def assert_arg_count(cnt, print_usage = lambda: None):
         sys.exit(-1)
 
 
+def stream_on_all(command, root_password=None):
+    deadline = time.time() + args.deadline if args.deadline else None
+    res = stream_multiple_hosts(config["hosts"], command, root_password=root_password, timeout=args.timeout,
+                                deadline=deadline, tee_dir=args.tee)
+
+    failed = [f"{host} ({err})" for host, err in res.items() if err not in {0, TIMEOUT_ERRCODE}]
+    timed_out = [host for host, err in res.items() if err == TIMEOUT_ERRCODE]
+    if failed:
+        print("WARNING: Command returned with error on hosts: %s" % ", ".join(failed))
+    if timed_out:
+        print("Timed out on hosts: %s" % ", ".join(timed_out))
+
+
 def run_on_all(command, root_password=None):
-    res = run_multiple_hosts(config["hosts"], command, root_password = root_password)
+    if args.stream or args.tee:
+        stream_on_all(command, root_password)
+        return
 
-    for host, (stdout, err) in res.items():
+    deadline = time.time() + args.deadline if args.deadline else None
+    timed_out = []
+
+    for host, (stdout, err) in iter_multiple_hosts(config["hosts"], command, root_password=root_password,
+                                                   timeout=args.timeout, deadline=deadline):
         print("---------------- %s ----------------" % host)
         print(stdout)
-        if err != 0:
+        if err == TIMEOUT_ERRCODE:
+            print("  WARNING: Command timed out. The output above is partial.")
+            timed_out.append(host)
+        elif err != 0:
             print("  WARNING: Command returned with error code %d" % err)
 
+    if timed_out:
+        print("Timed out on hosts: %s" % ", ".join(timed_out))
+
 
 def verify_slurm_args():
     assert (args.multi_gpu == 1) or (args.count), "In case of multi-GPU training, count must be specified."
@@ -119,16 +161,20 @@ if len(args.args)>0:
             do_setup()
         print("Setup done.")
 
-    elif args.args[0] == "copy":
+    elif args.args[0] in ["copy", "sync"]:
         assert_arg_count(0)
-        copy_local_dir()
+        if args.watch:
+            watch_and_sync()
+        else:
+            copy_local_dir()
 
     elif args.args[0] == "gather":
         def print_usage():
             print("Usage: gather <path>")
 
         assert_arg_count(1, print_usage)
-        gather_relative(args.args[1], config["hosts"], "postfix" if args.postfix else "on_conflict_confirm")
+        gather_relative(args.args[1], config["hosts"], "postfix" if args.postfix else "on_conflict_confirm",
+                        args.prune)
 
     elif args.args[0] == "run":
         cmd = " ".join(args.args[1:])
@@ -138,7 +184,11 @@ if len(args.args)>0:
         cmd = " ".join(args.args[1:])
         run_on_all(cmd, root_password=pswd)
     elif args.args[0] == "wandb":
+        # W&B and its dependencies take long to import, so only load them when needed.
+        from src import wandb_interface
         assert (args.multi_gpu == 1) or (args.per_gpu == 1), "You can't use multiple GPUs for a single run and multiple runs on a single GPU in the same time."
+        assert (args.multi_gpu == 1) or (args.runs_per_task == 1), "You can't use multiple GPUs for a single run and multiple runs per SLURM task in the same time."
+        assert args.runs_per_task >= 1 and args.per_gpu >= 1, "--runs_per_task and --per_gpu must be positive."
         os.environ['WANDB_API_KEY'] = config.get_wandb_api_key()
         if args.args[1] == "agent":
             try_set_counts_based_on_sweep(lambda: wandb_interface.get_config_count_from_sweepid(args.args[2]))
@@ -187,6 +237,18 @@ if len(args.args)>0:
             wandb_interface.remove_artifacts(args.args[2])
         else:
             assert False, "Invalid command"
+    elif args.args[0] == "cache":
+        def print_usage():
+            print("Usage: cache clear")
+
+        assert_arg_count(1, print_usage)
+        if args.args[1] != "clear":
+            print_usage()
+            sys.exit(-1)
+
+        src.cache.clear_all()
+        print("Cache cleared.")
+
     elif args.args[0] == "screen":
         if args.args[1] == "run":
             copy_local_dir()
@@ -209,3 +271,6 @@ if len(args.args)>0:
         kill_phantom_processes()      
     else:
         print("Invalid command: "+" ".join(args.args))
+
+if args.debug:
+    print(connection_pool.get_report())
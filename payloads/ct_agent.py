@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# Helper agent of cluster_tool. It is started once per host per invocation and answers JSON requests, one per line,
+# on stdin/stdout. Must stay compatible with Python 3.6.
+
+import hashlib
+import json
+import os
+import signal
+import stat
+import subprocess
+import sys
+
+VERSION = 7
+
+
+def op_list_dir(path):
+    path = os.path.expanduser(path)
+    if not os.path.isdir(path):
+        return None
+
+    res = []
+    for e in os.scandir(path):
+        res.append({"name": e.name, "is_dir": e.is_dir()})
+    return res
+
+
+def op_walk(path):
+    # All entries under path, except the hidden top-level ones: [relative path, size, mtime in ms, is directory]
+    path = os.path.expanduser(path)
+    if not os.path.isdir(path):
+        return None
+
+    res = []
+    for root, dirs, files in os.walk(path):
+        rel = os.path.relpath(root, path)
+        if rel == ".":
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            files = [f for f in files if not f.startswith(".")]
+
+        for name in dirs + files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            res.append([os.path.normpath(os.path.join(rel, name)), st.st_size, st.st_mtime_ns // 1000000,
+                        stat.S_ISDIR(st.st_mode)])
+    return res
+
+
+def op_hash(path, entries):
+    # SHA1 of all files in the given entries of path: {relative path: hash}
+    path = os.path.expanduser(path)
+    res = {}
+    for e in entries:
+        p = os.path.join(path, e)
+        files = [p] if os.path.isfile(p) else [os.path.join(r, f) for r, _, fs in os.walk(p) for f in fs]
+        for f in files:
+            if os.path.islink(f) or not os.path.isfile(f):
+                continue
+
+            h = hashlib.sha1()
+            try:
+                with open(f, "rb") as fd:
+                    for chunk in iter(lambda: fd.read(1 << 20), b""):
+                        h.update(chunk)
+            except OSError:
+                continue
+            res[os.path.relpath(f, path)] = h.hexdigest()
+    return res
+
+
+def op_run_index(path, ckpt_path=None, known=None):
+    # Directories of the W&B runs in path with their last modification time in ms and the newest file in their
+    # ckpt_path subdirectory. Only the directories with a modification time different from the known one are
+    # returned in "changed", but all of them are in "names".
+    path = os.path.expanduser(path)
+    if not os.path.isdir(path):
+        return None
+
+    known = known or {}
+    names = []
+    changed = {}
+    for e in os.scandir(path):
+        if e.name.startswith(".") or not e.is_dir(follow_symlinks=False):
+            continue
+
+        ckpt_dir = os.path.join(e.path, ckpt_path) if ckpt_path else None
+        mtime = 0
+        try:
+            mtime = e.stat(follow_symlinks=False).st_mtime_ns // 1000000
+            if ckpt_dir:
+                mtime = max(mtime, os.stat(ckpt_dir).st_mtime_ns // 1000000)
+        except OSError:
+            pass
+
+        names.append(e.name)
+        if known.get(e.name) == mtime:
+            continue
+
+        ckpt = None
+        if ckpt_dir and os.path.isdir(ckpt_dir):
+            files = []
+            for f in os.scandir(ckpt_dir):
+                try:
+                    if f.is_file():
+                        files.append((f.stat().st_mtime_ns, f.name))
+                except OSError:
+                    continue
+
+            if files:
+                ckpt = os.path.join(e.name, ckpt_path, max(files)[1])
+
+        changed[e.name] = [mtime, ckpt]
+    return {"names": names, "changed": changed}
+
+
+def op_stat(path):
+    try:
+        st = os.stat(os.path.expanduser(path))
+    except FileNotFoundError:
+        return {"exists": False}
+
+    return {"exists": True, "is_dir": os.path.isdir(os.path.expanduser(path)), "size": st.st_size,
+            "mtime": st.st_mtime}
+
+
+def query_csv(cmd):
+    out = subprocess.check_output(cmd, shell=True, stderr=subprocess.DEVNULL).decode()
+    return [[c.strip() for c in l.split(",")] for l in out.split("\n") if l.strip()]
+
+
+def op_gpu_query(nvidia_smi="nvidia-smi", gpu_fields="index,uuid", app_fields="gpu_uuid,pid"):
+    return {
+        "gpus": query_csv(nvidia_smi + " --query-gpu=" + gpu_fields + " --format=csv,noheader,nounits"),
+        "apps": query_csv(nvidia_smi + " --query-compute-apps=" + app_fields + " --format=csv,noheader,nounits")
+    }
+
+
+def op_ps(ps="ps"):
+    out = subprocess.check_output(ps + " -e -o user=,pid=,pgid=,ppid=,args=", shell=True).decode()
+    res = []
+    for l in out.split("\n"):
+        l = l.split(None, 4)
+        if len(l) < 4:
+            continue
+
+        res.append({"user": l[0], "pid": int(l[1]), "pgid": int(l[2]), "ppid": int(l[3]),
+                    "cmd": l[4] if len(l) > 4 else ""})
+    return res
+
+
+def op_spawn(cmd, cwd=None, env=None, wait=0):
+    # Starts cmd in a new session with the login shell of the user, like ssh would. If it exits within wait seconds
+    # (e.g. screen -d -m), its return code is returned as well, otherwise None.
+    full_env = dict(os.environ)
+    full_env.update(env or {})
+    proc = subprocess.Popen(cmd, shell=True, executable=os.environ.get("SHELL") or None,
+                            cwd=os.path.expanduser(cwd) if cwd else None, env=full_env, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+    returncode = None
+    if wait:
+        try:
+            returncode = proc.wait(wait)
+        except subprocess.TimeoutExpired:
+            pass
+    return {"pid": proc.pid, "returncode": returncode}
+
+
+def op_kill(pid, sig=int(signal.SIGTERM), group=False):
+    if group:
+        os.killpg(pid, sig)
+    else:
+        os.kill(pid, sig)
+    return True
+
+
+OPS = {
+    "list_dir": op_list_dir,
+    "stat": op_stat,
+    "walk": op_walk,
+    "hash": op_hash,
+    "run_index": op_run_index,
+    "gpu_query": op_gpu_query,
+    "ps": op_ps,
+    "spawn": op_spawn,
+    "kill": op_kill,
+}
+
+
+def send(msg):
+    sys.stdout.write(json.dumps(msg) + "\n")
+    sys.stdout.flush()
+
+
+def main():
+    send({"version": VERSION})
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+
+        req = json.loads(line)
+        try:
+            send({"id": req["id"], "result": OPS[req["op"]](**req.get("args", {}))})
+        except Exception as e:
+            send({"id": req["id"], "error": "%s: %s" % (type(e).__name__, e)})
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# Runs multiple runs within a single SLURM task: <per_gpu> of them in parallel on the same GPU, and each of those
+# sequentially, up to <max runs> runs in total, as long as the next run is expected to fit in the time budget.
+# Each run gets a unique CT_RUN_INDEX (0-based, over the whole array), which resume_jobs.py uses to pick its run.
+
+import os
+import subprocess
+import sys
+import threading
+import time
+
+if len(sys.argv) != 6:
+    print("Usage: %s <per_gpu> <max runs> <time budget in seconds> <total runs, 0 if unlimited> <command>" %
+          sys.argv[0])
+    sys.exit(-1)
+
+per_gpu = int(sys.argv[1])
+max_runs = int(sys.argv[2])
+budget = float(sys.argv[3])
+n_total = int(sys.argv[4])
+command = sys.argv[5]
+
+start_time = time.time()
+task_id = int(os.environ.get("SLURM_ARRAY_TASK_ID", "1")) - 1
+first_index = task_id * max_runs
+
+mutex = threading.Lock()
+next_slot = [0]
+longest = [0.0]
+errors = [0]
+
+
+def claim_slot():
+    with mutex:
+        slot = next_slot[0]
+        if slot >= max_runs or (n_total and first_index + slot >= n_total):
+            return None
+
+        # The first runs of the lanes always start. Later ones only if the longest run so far would still fit.
+        if slot >= per_gpu and time.time() - start_time + longest[0] > budget:
+            return None
+
+        next_slot[0] += 1
+        return first_index + slot
+
+
+def lane():
+    while True:
+        index = claim_slot()
+        if index is None:
+            return
+
+        print("PACK: starting run %d" % index)
+        sys.stdout.flush()
+        env = dict(os.environ, CT_RUN_INDEX=str(index))
+        t = time.time()
+        ret = subprocess.call(command, shell=True, env=env)
+        with mutex:
+            longest[0] = max(longest[0], time.time() - t)
+            if ret != 0:
+                errors[0] += 1
+
+        print("PACK: run %d finished with code %d in %.0f seconds" % (index, ret, time.time() - t))
+        sys.stdout.flush()
+
+
+lanes = [threading.Thread(target=lane) for _ in range(min(per_gpu, max_runs))]
+for l in lanes:
+    l.start()
+for l in lanes:
+    l.join()
+
+if next_slot[0] < max_runs and not (n_total and first_index + next_slot[0] >= n_total):
+    print("PACK: out of time, %d runs of this task were not started" % (max_runs - next_slot[0]))
+
+sys.exit(1 if errors[0] else 0)
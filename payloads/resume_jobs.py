@@ -1,56 +1,73 @@
 #!/usr/bin/env python3
 
 import sys
-import wandb
 import glob
+import json
 import os
 
-if len(sys.argv) != 6:
-    print(f"Usage: {sys.argv[0]} <sweep id> <wandb_dir_template> <command> <force> <force2>")
+if len(sys.argv) not in {6, 7}:
+    print(f"Usage: {sys.argv[0]} <sweep id> <wandb_dir_template> <command> <force> <force2> [manifest]")
 
 path_template = sys.argv[2]
 cmd_template = sys.argv[3]
 force = sys.argv[4] != "0"
 force2 = sys.argv[5] != "0"
+manifest = sys.argv[6] if len(sys.argv) > 6 else None
 
-sweep = wandb.Api().sweep(sys.argv[1])
-r_to_start = [r for r in sweep.runs if (force2 or (force and r.state!="running") or r.state=="crashed")]
-r_to_start.sort(key=lambda x: x.id)
+# The index of the run to resume. CT_RUN_INDEX (0-based) takes precedence over the SLURM array task ID (1-based).
+if "CT_RUN_INDEX" in os.environ:
+    task_id = int(os.environ["CT_RUN_INDEX"])
+else:
+    task_id = int(os.environ['SLURM_ARRAY_TASK_ID']) - 1
 
-task_id = int(os.environ['SLURM_ARRAY_TASK_ID']) - 1
+if manifest:
+    # Written by ct at submission time, so there is no need to query the sweep from every task.
+    with open(manifest) as f:
+        r_to_start = json.load(f)["runs"]
+else:
+    import wandb
+    sweep = wandb.Api().sweep(sys.argv[1])
+    r_to_start = [{"id": r.id, "ckpt": None} for r in sweep.runs
+                  if (force2 or (force and r.state!="running") or r.state=="crashed")]
+    r_to_start.sort(key=lambda x: x["id"])
 
 print(f"RESUME: task id: {task_id}")
 if task_id >= len(r_to_start):
-    print(f"Error: Job ID ({task_id}) > num of jobs ({r_to_start})")
+    print(f"Error: Job ID ({task_id}) > num of jobs ({len(r_to_start)})")
     exit(-1)
 
 r = r_to_start[task_id]
+run_id = r["id"]
 
-savedir_name = sys.argv[2].replace("${id}", r.id)
-savedir = glob.glob(savedir_name)
-if not savedir:
-    savedir_name_alt = f"save/{savedir_name}"
-    print(f"Warning: Save directory ({savedir_name}) not found for {r.id}. Trying alternative {savedir_name_alt}...")
-
-    savedir = glob.glob(savedir_name_alt)
+if r["ckpt"] and os.path.isfile(r["ckpt"]):
+    ckpt = r["ckpt"]
+else:
+    savedir_name = path_template.replace("${id}", run_id)
+    savedir = glob.glob(savedir_name)
     if not savedir:
-        print(f"Error: Save directory ({savedir_name_alt}) not found for {r.id}. Exiting...")
-        exit(-1)
+        savedir_name_alt = f"save/{savedir_name}"
+        print(f"Warning: Save directory ({savedir_name}) not found for {run_id}. Trying alternative {savedir_name_alt}...")
 
-flist = []
-for sd in savedir:
-    for f in os.listdir(sd):
-        p = os.path.join(sd, f)
-        if os.path.isfile(p):
-            flist.append(p)
-flist.sort(key=lambda x: os.path.getmtime(x))
+        savedir = glob.glob(savedir_name_alt)
+        if not savedir:
+            print(f"Error: Save directory ({savedir_name_alt}) not found for {run_id}. Exiting...")
+            exit(-1)
 
-if len(flist) == 0:
-    print(f"Warning: No checkpoint found for {r.id}. Skipping...")
-    exit(-1)
+    flist = []
+    for sd in savedir:
+        for f in os.listdir(sd):
+            p = os.path.join(sd, f)
+            if os.path.isfile(p):
+                flist.append(p)
+    flist.sort(key=lambda x: os.path.getmtime(x))
+
+    if len(flist) == 0:
+        print(f"Warning: No checkpoint found for {run_id}. Skipping...")
+        exit(-1)
+
+    ckpt = flist[-1]
 
-ckpt = flist[-1]
-print(f"Run {r.id}: Found checkpoint to resume: {ckpt}")
+print(f"Run {run_id}: Found checkpoint to resume: {ckpt}")
 
 cmd = cmd_template.replace("${ckpt}", ckpt)
 print(f"Running command {cmd}")
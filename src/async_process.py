@@ -0,0 +1,188 @@
+import asyncio
+import subprocess
+import threading
+import queue
+from typing import Dict, List, Optional, Tuple, Callable
+from .config import config
+from .ssh_pool import connection_pool
+from . import process_tools
+from .process_tools import get_remote_command, get_multi_host_command, get_timeout, get_deadline, HostCallLimiter, \
+    TIMEOUT_ERRCODE, timed_process_groups, kill_process_group, should_retry
+
+# asyncio based alternative to the thread based remote execution. A single thread can drive thousands of hosts,
+# limited only by the number of subprocesses (and their pipes) allowed to exist at the same time.
+MAX_PROCESSES = config.get("async_max_processes", 256)
+
+
+class AsyncRunner:
+    # Must be created inside the event loop it is used in.
+
+    def __init__(self):
+        self.process_slots = asyncio.Semaphore(MAX_PROCESSES)
+
+    async def connect(self, hosts: List[str], deadlines: Optional[Dict[str, Optional[float]]] = None):
+        await connection_pool.open_masters_async(hosts, self.process_slots, deadlines)
+
+    async def run_process(self, command: str, input: Optional[str] = None,
+                          timeout: Optional[float] = None) -> Tuple[str, int]:
+        if process_tools.DEBUG:
+            print("RUN: ", command)
+
+        if timeout is not None and timeout <= 0:
+            return "", TIMEOUT_ERRCODE
+
+        async with self.process_slots:
+            proc = await asyncio.create_subprocess_shell(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                                         start_new_session=timeout is not None)
+            if timeout is None:
+                stdout, _ = await proc.communicate(input.encode() if input is not None else None)
+                return stdout.decode(), proc.returncode
+
+            # Read the output in a separate task, so that the partial output is available on timeout.
+            chunks = []
+
+            async def read_output():
+                if input is not None:
+                    proc.stdin.write(input.encode())
+                proc.stdin.close()
+                while True:
+                    data = await proc.stdout.read(65536)
+                    if not data:
+                        break
+                    chunks.append(data)
+                return await proc.wait()
+
+            timed_process_groups.add(proc.pid)
+            try:
+                returncode = await asyncio.wait_for(read_output(), timeout)
+            except asyncio.TimeoutError:
+                kill_process_group(proc.pid)
+                await proc.wait()
+                returncode = TIMEOUT_ERRCODE
+            finally:
+                timed_process_groups.discard(proc.pid)
+
+            return b"".join(chunks).decode(), returncode
+
+    async def remote_run(self, host: str, command: str, alternative=True, root_password: Optional[str] = None,
+                         add_sudo=True, timeout: Optional[float] = None, deadline: Optional[float] = None,
+                         input: Optional[str] = None) -> Tuple[str, int]:
+        # Same limits and retries as process_tools.remote_run.
+        end = get_deadline(host, timeout, deadline)
+        command = get_remote_command(host, command, alternative, root_password, add_sudo, end)
+        if root_password:
+            input = root_password + "\n" + (input or "")
+
+        async with HostCallLimiter(host):
+            stdout, errcode = await self.run_process(command, input, get_timeout(host, None, end))
+            # The handlers may block (e.g. to refresh a key), so they don't run in the event loop.
+            if errcode == process_tools.SSH_ERRCODE and \
+                    await asyncio.get_running_loop().run_in_executor(None, should_retry, host, errcode):
+                stdout, errcode = await self.run_process(command, input, get_timeout(host, None, end))
+
+        if root_password:
+            stdout = stdout.replace(root_password, "")
+        return stdout, errcode
+
+    async def run_multiple_hosts(self, hosts: List[str], command: str, relative=True, alternative=True,
+                                 root_password: Optional[str] = None, timeout: Optional[float] = None,
+                                 deadline: Optional[float] = None,
+                                 on_result: Callable[[str, Tuple[str, int]], None] = lambda h, r: None
+                                 ) -> Dict[str, Tuple[str, int]]:
+        # The time limit of each host starts now, so that it includes opening the connection.
+        deadlines = {h: get_deadline(h, timeout, deadline) for h in hosts}
+        await self.connect(hosts, deadlines)
+
+        async def run_it(host):
+            cmd = get_multi_host_command(host, command, relative, root_password)
+            res = await self.remote_run(host, cmd, alternative=alternative, root_password=root_password,
+                                        add_sudo=False, deadline=deadlines[host])
+            on_result(host, res)
+            return res
+
+        res = await asyncio.gather(*[run_it(h) for h in hosts])
+        return {k: r for k, r in zip(hosts, res)}
+
+    async def run_multiple_on_multiple(self, hosts: List[str], commands: List[str],
+                                       root_password: Optional[str] = None, timeout: Optional[float] = None,
+                                       deadline: Optional[float] = None) -> Dict[str, Tuple[List[str], int]]:
+        await self.connect(hosts, {h: get_deadline(h, timeout, deadline) for h in hosts})
+
+        async def run_commands(host):
+            out = []
+            for c in commands:
+                stdout, err = await self.remote_run(host, c, root_password=root_password, timeout=timeout,
+                                                    deadline=deadline)
+                if err != 0:
+                    print("WARNING: command %s failed on host %s" % (c, host))
+                    return (out, err)
+
+                out.append(stdout)
+
+            return (out, 0)
+
+        res = await asyncio.gather(*[run_commands(h) for h in hosts])
+        return {k: r for k, r in zip(hosts, res)}
+
+
+def run_sync(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+# Synchronous wrappers with the same interface as the ones in process_tools.
+
+def remote_run(host, command, alternative=True, root_password: Optional[str] = None, add_sudo=True,
+               timeout: Optional[float] = None, deadline: Optional[float] = None, input: Optional[str] = None):
+    async def run():
+        # The time limit starts now, so that it includes opening the connection.
+        end = get_deadline(host, timeout, deadline)
+        runner = AsyncRunner()
+        await runner.connect([host], {host: end})
+        return await runner.remote_run(host, command, alternative, root_password, add_sudo, deadline=end,
+                                       input=input)
+    return run_sync(run())
+
+
+def run_multiple_hosts(hosts, command, relative=True, alternative=True, root_password: Optional[str] = None,
+                       timeout: Optional[float] = None, deadline: Optional[float] = None):
+    async def run():
+        return await AsyncRunner().run_multiple_hosts(list(hosts), command, relative, alternative, root_password,
+                                                      timeout, deadline)
+    return run_sync(run())
+
+
+def iter_multiple_hosts(hosts, command, relative=True, alternative=True, root_password: Optional[str] = None,
+                        timeout: Optional[float] = None, deadline: Optional[float] = None):
+    # Runs the event loop in a background thread and yields (host, result) pairs as the hosts finish.
+    results = queue.Queue()
+
+    async def run():
+        await AsyncRunner().run_multiple_hosts(list(hosts), command, relative, alternative, root_password, timeout,
+                                               deadline, on_result=lambda h, r: results.put((h, r)))
+
+    def run_in_thread():
+        try:
+            run_sync(run())
+        except BaseException as e:
+            results.put(e)
+        results.put(None)
+
+    threading.Thread(target=run_in_thread, daemon=True).start()
+    while True:
+        res = results.get()
+        if res is None:
+            return
+        elif isinstance(res, BaseException):
+            raise res
+        yield res
+
+
+def run_multiple_on_multiple(hosts, command, root_password: Optional[str] = None, timeout: Optional[float] = None,
+                             deadline: Optional[float] = None):
+    async def run():
+        return await AsyncRunner().run_multiple_on_multiple(list(hosts), command, root_password, timeout, deadline)
+    return run_sync(run())
@@ -0,0 +1,126 @@
+import os
+import json
+import shutil
+import time
+import tempfile
+from contextlib import contextmanager
+from threading import Lock
+from typing import Any, Callable, Dict, Optional, Tuple
+from .utils import get_cache_dir
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+# Ignore all cached values (they are still updated). Set by --refresh.
+REFRESH = False
+
+
+class JSONCache:
+    # A small persistent key-value store with per-entry timestamps, saved as a JSON file in the cache directory.
+    # Only the keys changed by this process are written back, while holding a lock on the file, so concurrent
+    # invocations don't lose each other's entries. Without fcntl (Windows) there is no lock, and concurrent writes
+    # can lose entries.
+
+    def __init__(self, name: str):
+        self.path = os.path.join(get_cache_dir(), name + ".json")
+        self.mutex = Lock()
+        self.data = None
+
+    def read_file(self) -> Dict[str, Any]:
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def load(self) -> Dict[str, Any]:
+        if self.data is None:
+            self.data = self.read_file()
+        return self.data
+
+    @contextmanager
+    def file_lock(self):
+        # Between processes. The threads of this process are serialized by self.mutex.
+        if fcntl is None:
+            yield
+            return
+
+        with open(self.path + ".lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def update_file(self, update: Callable[[Dict[str, Any]], None]):
+        # Reads the current content of the file, applies update to it in place and writes it back atomically.
+        with self.file_lock():
+            data = self.read_file()
+            update(data)
+
+            fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(self.path))
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(tmpname, self.path)
+
+    def write_changes(self, changed: Dict[str, Any]):
+        def update(data):
+            for k, v in changed.items():
+                if v is None:
+                    data.pop(k, None)
+                else:
+                    data[k] = v
+
+        self.update_file(update)
+
+    def get(self, key: str, ttl: Optional[float] = None) -> Optional[Any]:
+        # Returns the value if it is younger than ttl seconds (or any age if ttl is None).
+        if REFRESH:
+            return None
+
+        with self.mutex:
+            entry = self.load().get(key)
+
+        if entry is None or (ttl is not None and time.time() - entry["time"] > ttl):
+            return None
+        return entry["value"]
+
+    def set(self, key: str, value: Any, timestamp: Optional[float] = None):
+        entry = {"time": time.time() if timestamp is None else timestamp, "value": value}
+        with self.mutex:
+            self.load()[key] = entry
+            self.write_changes({key: entry})
+
+    def peek(self, key: str) -> Tuple[Optional[Any], Optional[float]]:
+        # Returns the value and its timestamp regardless of its age and REFRESH.
+        with self.mutex:
+            entry = self.load().get(key)
+        return (entry["value"], entry["time"]) if entry else (None, None)
+
+    def invalidate(self, key: str):
+        with self.mutex:
+            self.load().pop(key, None)
+            self.write_changes({key: None})
+
+    def invalidate_prefix(self, prefix: str):
+        def update(data):
+            for k in [k for k in data.keys() if k.startswith(prefix)]:
+                data.pop(k)
+
+        with self.mutex:
+            update(self.load())
+            self.update_file(update)
+
+
+def clear_all():
+    # Deletes all the cached information, but not the sockets of the persistent SSH connections.
+    base = get_cache_dir()
+    for name in os.listdir(base):
+        path = os.path.join(base, name)
+        if name.endswith(".json"):
+            os.remove(path)
+        elif name == "sync_manifests":
+            shutil.rmtree(path)
@@ -42,6 +42,7 @@ class Config:
         self.slurm_machine_whitelist = None
         self.enabled_gpu_types = None
         self.slurm_partition = None
+        self.runs_per_task = 1
         for f in self.files:
             self.update_if_available(f)
 
@@ -71,6 +72,7 @@ class Config:
         self.set_slurm_partition(args.slurm_partition)
         self.num_cpus = args.num_cpus if args.num_cpus else None
         self.memory = args.memory if args.memory else None
+        self.runs_per_task = args.runs_per_task
 
     def create_gpu_filters(self, host_list: List[str]):
         res_hosts = []
@@ -1,56 +1,202 @@
 import subprocess
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Any, Tuple
 from .process_tools import remote_run
+from . import remote_agent
+from .remote_agent import RemoteAgentError
 from .parallel_map import parallel_map_dict
 from .config import config
-import functools
+from .cache import JSONCache
 
+# Static facts change rarely, so they are cached for a long time. The occupancy is cached only for a short time.
+STATIC_GPU_QUERY = ["index", "uuid", "name", "memory.total", "driver_version"]
+DYNAMIC_GPU_QUERY = ["index", "uuid", "memory.used", "utilization.gpu"]
+APP_QUERY = ["gpu_uuid", "pid"]
+PROBE_SEPARATOR = "----"
 
-def get_free_gpus(host: str, ignore_used: bool) -> Optional[List[int]]:
+gpu_cache = JSONCache("gpu_inventory")
+
+# PID used in the cache for the GPUs allocated by ct itself, before they show up in nvidia-smi.
+PLACEHOLDER_PID = -1
+
+
+def parse_int(s: str) -> Optional[int]:
+    # nvidia-smi reports [N/A] or [Not Supported] for some fields on some GPUs
+    try:
+        return int(float(s))
+    except ValueError:
+        return None
+
+
+def parse_csv(text: str) -> List[List[str]]:
+    return [[c.strip() for c in l.split(",")] for l in text.split("\n") if l.strip()]
+
+
+def parse_probe(fields: List[str], gpu_rows: List[List[str]], app_rows: List[List[str]]) -> List[Dict[str, Any]]:
+    pids = {}
+    for uuid, pid in app_rows:
+        pids.setdefault(uuid, []).append(parse_int(pid))
+
+    numeric = {"memory.used", "memory.total", "utilization.gpu"}
+    gpus = []
+    for row in gpu_rows:
+        gpu = {}
+        for field, value in zip(fields, row):
+            if field == "index":
+                value = int(value)
+            elif field in numeric:
+                value = parse_int(value)
+
+            gpu[field.replace(".gpu", "").replace(".", "_")] = value
+
+        gpu["pids"] = pids.get(gpu["uuid"], [])
+        gpus.append(gpu)
+    return gpus
+
+
+def probe_gpus_with_shell(host: str, fields: List[str]) -> Optional[List[Dict[str, Any]]]:
     nvidia_smi = config.get_command(host, "nvidia-smi")
+    echo = config.get_command(host, "echo")
+
+    # Single round-trip for both queries
+    stdout, ret = remote_run(host, f"{nvidia_smi} --query-gpu={','.join(fields)} --format=csv,noheader,nounits && "
+                                   f"{echo} {PROBE_SEPARATOR} && "
+                                   f"{nvidia_smi} --query-compute-apps={','.join(APP_QUERY)} "
+                                   f"--format=csv,noheader,nounits", alternative=False)
+    if ret != 0:
+        return None
+
+    gpus, apps = stdout.split(PROBE_SEPARATOR + "\n")
+    return parse_probe(fields, parse_csv(gpus), parse_csv(apps))
 
+
+def probe_gpus(host: str, fields: List[str]) -> Optional[List[Dict[str, Any]]]:
+    # Queries the given fields of all GPUs of the host, together with the PIDs of the processes using them, in a
+    # single remote call. None if the host can't be queried.
     try:
-        free = []
-        stdout, ret = remote_run(host, nvidia_smi+" --query-compute-apps=gpu_uuid --format=csv,noheader,nounits")
-        if ret!=0:
-            return None
+        try:
+            res = remote_agent.call(host, "gpu_query", nvidia_smi=config.get_command(host, "nvidia-smi"),
+                                    gpu_fields=",".join(fields), app_fields=",".join(APP_QUERY))
+            return parse_probe(fields, res["gpus"], res["apps"])
+        except RemoteAgentError:
+            return probe_gpus_with_shell(host, fields)
+    except:
+        return None
+
+
+def split_static(gpus: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    static_keys = {"index", "uuid", "name", "memory_total", "driver_version"}
+    return [{k: v for k, v in g.items() if k in static_keys} for g in gpus], \
+           [{k: v for k, v in g.items() if k not in static_keys or k == "uuid"} for g in gpus]
+
+
+def merge_static(static: List[Dict[str, Any]], dynamic: List[Dict[str, Any]]) -> Optional[List[Dict[str, Any]]]:
+    dynamic = {g["uuid"]: g for g in dynamic}
+    if set(dynamic.keys()) != {g["uuid"] for g in static}:
+        # The hardware changed
+        return None
 
-        uuids = [s.strip() for s in stdout.split("\n") if s]
+    return [dict(g, **dynamic[g["uuid"]]) for g in static]
 
-        stdout, ret = remote_run(host, nvidia_smi+" --query-gpu=index,uuid --format=csv,noheader,nounits")
-        if ret != 0:
+
+def get_host_gpus(host: str) -> Optional[List[Dict[str, Any]]]:
+    # Returns the GPU inventory of the host, with the memory usage, utilization and PIDs. Uses the cache if the
+    # information is fresh enough.
+    cache_cfg = config.get("gpu_cache", {})
+    static = gpu_cache.get(f"{host}/static", cache_cfg.get("static_ttl", 7 * 24 * 3600))
+    dynamic = gpu_cache.get(f"{host}/dynamic", cache_cfg.get("ttl", 30))
+
+    if static is not None and dynamic is not None:
+        gpus = merge_static(static, dynamic)
+        if gpus is not None:
+            return gpus
+
+    if static is not None:
+        gpus = probe_gpus(host, DYNAMIC_GPU_QUERY)
+        gpus = merge_static(static, gpus) if gpus is not None else None
+        if gpus is None:
+            static = None
+
+    if static is None:
+        gpus = probe_gpus(host, list(dict.fromkeys(STATIC_GPU_QUERY + DYNAMIC_GPU_QUERY)))
+        if gpus is None:
             return None
+        gpu_cache.set(f"{host}/static", split_static(gpus)[0])
 
-        id_uid_pair = [s.strip().split(", ") for s in stdout.split("\n") if s]
+    gpu_cache.set(f"{host}/dynamic", split_static(gpus)[1])
+    return gpus
 
-        for i in id_uid_pair:
-            id, uid = i
 
-            if uid not in uuids or ignore_used:
-                free.append(int(id))
+def mark_gpus_used(used: Dict[str, List[int]]):
+    # Mark the GPUs on which runs were just started as used in the cache, so that the next invocation doesn't
+    # allocate them again before the cache expires.
+    for host, indices in used.items():
+        static, _ = gpu_cache.peek(f"{host}/static")
+        dynamic, timestamp = gpu_cache.peek(f"{host}/dynamic")
+        if not indices or static is None or dynamic is None:
+            continue
 
-        return config.filter_gpus_host(host, free)
-    except:
+        used_uuids = {g["uuid"] for g in static if g["index"] in indices}
+        for g in dynamic:
+            if g["uuid"] in used_uuids:
+                g["pids"] = g["pids"] + [PLACEHOLDER_PID]
+
+        gpu_cache.set(f"{host}/dynamic", dynamic, timestamp)
+
+
+def parse_topology(text: str) -> Dict[str, Dict[str, str]]:
+    # Parses the GPU part of the output of nvidia-smi topo -m into {gpu index: {other gpu index: link type}}
+    lines = [l.split() for l in text.split("\n") if l.strip()]
+    if not lines:
+        return {}
+
+    columns = [c[3:] for c in lines[0] if c.startswith("GPU")]
+    res = {}
+    for l in lines[1:]:
+        if not (l[0].startswith("GPU") and l[0][3:].isdigit()):
+            continue
+
+        res[l[0][3:]] = {c: v for c, v in zip(columns, l[1:]) if v != "X"}
+    return res
+
+
+def get_host_topology(host: str) -> Optional[Dict[str, Dict[str, str]]]:
+    # Interconnect type between the GPUs of the host (NV#, PIX, PXB, PHB, NODE, SYS). Static, cached for long.
+    topo = gpu_cache.get(f"{host}/topology", config.get("gpu_cache", {}).get("static_ttl", 7 * 24 * 3600))
+    if topo is not None:
+        return topo
+
+    nvidia_smi = config.get_command(host, "nvidia-smi")
+    stdout, ret = remote_run(host, f"{nvidia_smi} topo -m", alternative=False)
+    if ret != 0:
         return None
 
+    topo = parse_topology(stdout)
+    gpu_cache.set(f"{host}/topology", topo)
+    return topo
 
-def get_free_gpu_list(ignore_used: bool):
-    return parallel_map_dict(config["hosts"], functools.partial(get_free_gpus, ignore_used=ignore_used))
 
+def get_gpu_inventory() -> Dict[str, Optional[List[Dict[str, Any]]]]:
+    return parallel_map_dict(config["hosts"], get_host_gpus)
 
-def get_top_gpus(n_runs: Optional[int], gpu_per_run: int = 1, ignore_used: bool = False) -> Dict[str, List[int]]:
-    free_gpus = get_free_gpu_list(ignore_used)
 
-    if n_runs is None:
-        return free_gpus
+def get_free_gpus_from_inventory(host: str, gpus: Optional[List[Dict[str, Any]]], ignore_used: bool) -> \
+        Optional[List[int]]:
+    if gpus is None:
+        return None
+
+    free = [g["index"] for g in gpus if ignore_used or not g["pids"]]
+    return config.filter_gpus_host(host, free)
+
+
+def get_free_gpus(host: str, ignore_used: bool) -> Optional[List[int]]:
+    return get_free_gpus_from_inventory(host, get_host_gpus(host), ignore_used)
+
+
+def get_free_gpu_list(ignore_used: bool):
+    return {h: get_free_gpus_from_inventory(h, gpus, ignore_used) for h, gpus in get_gpu_inventory().items()}
 
-    use_gpus = {}
-    n_used = 0
-    for host in config["hosts"]:
-        this_gpus = free_gpus.get(host, [])
-        use_gpus[host] = this_gpus[:n_runs * gpu_per_run - n_used]
-        n_used += len(use_gpus[host]) // gpu_per_run
-        if n_used >= n_runs:
-            break
 
-    return use_gpus
+def get_top_gpus(n_runs: Optional[int], gpu_per_run: int = 1, ignore_used: bool = False) -> Dict[str, List[int]]:
+    # Imported here, because placement depends on this module.
+    from .placement import place_runs
+    return place_runs(n_runs, gpu_per_run, ignore_used)
@@ -1,27 +1,172 @@
-from typing import Iterable, Callable, List, Any
+from typing import Iterable, Callable, List, Any, Iterator, Tuple, Optional, Dict
+from contextlib import contextmanager
+from .config import config
 import threading
+import queue
+import time
 
 
-def parallel_map(iterator: Iterable, fn: Callable[[Any], Any]) -> List[Any]:
-    res = []
+class WorkerSlots:
+    # Global limit on the number of concurrently running work items (and hence ssh processes), shared by all
+    # parallel_map calls. A worker that starts a nested parallel_map gives up its slot while waiting for it, so
+    # nested calls can't deadlock.
 
-    def thread_fn(index, data):
-        res[index] = fn(data)
+    def __init__(self, n: int):
+        self.semaphore = threading.Semaphore(n)
+        self.local = threading.local()
 
-    threads = []
+    def acquire(self):
+        self.semaphore.acquire()
+        self.local.has_slot = True
 
-    for i in iterator:
-        res.append(None)
-        t = threading.Thread(target=thread_fn, args=(len(res)-1, i))
-        t.start()
-        threads.append(t)
+    def release(self):
+        self.local.has_slot = False
+        self.semaphore.release()
 
-    for t in threads:
-        t.join()
+    @contextmanager
+    def waiting(self):
+        held = getattr(self.local, "has_slot", False)
+        if held:
+            self.release()
+        try:
+            yield
+        finally:
+            if held:
+                self.acquire()
 
-    return res
 
+MAX_WORKERS = config.get("max_parallel", 64)
+worker_slots = WorkerSlots(MAX_WORKERS)
 
-def parallel_map_dict(hosts, fn):
-    res = parallel_map(hosts, fn)
+
+def parallel_iter(iterator: Iterable, fn: Callable[[Any], Any], max_workers: Optional[int] = None,
+                  timeout: Optional[float] = None, ordered: bool = True, return_exceptions: bool = False,
+                  deadline: Optional[float] = None) -> Iterator[Tuple[Any, Any]]:
+    # Runs fn on all items in parallel and yields (item, result) pairs, either in the order of the input or as they
+    # complete. At most max_workers items of this call and MAX_WORKERS items in total are running at the same time.
+    # If an item runs longer than timeout seconds, or it is not finished until the deadline (absolute time.time()),
+    # its result is a TimeoutError (the thread is abandoned). If fn raises, the exception is reraised here and the
+    # items not started yet are cancelled, unless return_exceptions is set, in which case the exception is returned
+    # as the result.
+
+    items = list(iterator)
+    if not items:
+        return
+
+    n_workers = min(len(items), max_workers or MAX_WORKERS)
+    results = queue.Queue()
+    mutex = threading.Lock()
+    cancelled = threading.Event()
+    next_index = [0]
+    started: Dict[int, float] = {}
+    abandoned = set()
+
+    def worker():
+        while not cancelled.is_set():
+            with mutex:
+                index = next_index[0]
+                if index >= len(items):
+                    return
+                next_index[0] += 1
+
+            worker_slots.acquire()
+            try:
+                if cancelled.is_set():
+                    return
+
+                with mutex:
+                    started[index] = time.time()
+
+                try:
+                    res = (index, True, fn(items[index]))
+                except BaseException as e:
+                    res = (index, False, e)
+
+                with mutex:
+                    del started[index]
+                results.put(res)
+            finally:
+                worker_slots.release()
+
+            with mutex:
+                if index in abandoned:
+                    # A replacement worker was started for this one.
+                    return
+
+    def start_worker():
+        threading.Thread(target=worker, daemon=True).start()
+
+    for _ in range(n_workers):
+        start_worker()
+
+    done = {}
+    finished = set()
+    next_to_yield = 0
+    try:
+        with worker_slots.waiting():
+            while len(finished) < len(items):
+                wait = 0.5
+                if deadline is not None:
+                    now = time.time()
+                    if now >= deadline:
+                        cancelled.set()
+                        with mutex:
+                            abandoned.update(started.keys())
+
+                        for i in range(len(items)):
+                            if i not in finished:
+                                results.put((i, False, TimeoutError("Deadline exceeded")))
+                        deadline = None
+                    else:
+                        wait = min(wait, deadline - now)
+
+                if timeout is not None:
+                    now = time.time()
+                    with mutex:
+                        expired = [i for i, t in started.items() if now - t > timeout and i not in abandoned]
+                        abandoned.update(expired)
+                        running = [t for i, t in started.items() if i not in abandoned]
+
+                    for i in expired:
+                        results.put((i, False, TimeoutError(f"Timeout after {timeout} seconds")))
+                        start_worker()
+
+                    if running:
+                        wait = max(min(wait, min(running) + timeout - now), 0.01)
+
+                try:
+                    index, ok, res = results.get(timeout=wait)
+                except queue.Empty:
+                    continue
+
+                if index in finished:
+                    # Finished after it was already timed out.
+                    continue
+
+                if not ok and not return_exceptions:
+                    raise res
+
+                finished.add(index)
+                done[index] = res
+                if not ordered:
+                    yield items[index], done.pop(index)
+                    continue
+
+                while next_to_yield in done:
+                    yield items[next_to_yield], done.pop(next_to_yield)
+                    next_to_yield += 1
+    finally:
+        cancelled.set()
+
+
+def parallel_map(iterator: Iterable, fn: Callable[[Any], Any], max_workers: Optional[int] = None,
+                 timeout: Optional[float] = None, return_exceptions: bool = False,
+                 deadline: Optional[float] = None) -> List[Any]:
+    return [r for _, r in parallel_iter(iterator, fn, max_workers, timeout, ordered=True,
+                                        return_exceptions=return_exceptions, deadline=deadline)]
+
+
+def parallel_map_dict(hosts, fn, **kwargs):
+    hosts = list(hosts)
+    res = parallel_map(hosts, fn, **kwargs)
     return {k: r for k, r in zip(hosts, res)}
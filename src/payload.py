@@ -1,4 +1,5 @@
 import os
+import hashlib
 from .config import config
 from .process_tools import remote_run
 from .parallel_map import parallel_map
@@ -9,11 +10,13 @@ def get_bindir(host):
     return config.get("bin_dir", {}).get(host, "~/.local/bin")
 
 
-def send_payload(hosts, name: str):
+def send_payload(hosts, name: str, force: bool = False):
     # sbatch allows queueuing only batch files, but not binaries, so we can't do sbatch <args> srun <cmd>. So make a
     # not_srun command which is a bash script that calls srun and passes all args to it
     with open(os.path.dirname(os.path.abspath(__file__)) + f"/../payloads/{name}", "rb") as file:
-        payload = base64.b64encode(file.read()).decode()
+        data = file.read()
+        payload = base64.b64encode(data).decode()
+        digest = hashlib.sha1(data).hexdigest()
 
     def install_to_host(host):
         tdir = get_bindir(host)
@@ -22,9 +25,13 @@ def send_payload(hosts, name: str):
         echo = config.get_command(host, "echo")
         bash = config.get_command(host, "bash")
         chmod = config.get_command(host, "chmod")
+        sha1sum = config.get_command(host, "sha1sum")
 
-        remote_run(host, f"{mkdir} -p {tdir}")
-        remote_run(host, f"{bash} -c \"{echo} {payload} |{base64} -d > {tdir}/{name}\"")
-        remote_run(host, f"{chmod} +x {tdir}/{name}")
+        # A single round-trip. The file is written only if it is missing or its checksum differs (or if forced).
+        install = f"{mkdir} -p {tdir} && {bash} -c \"{echo} {payload} |{base64} -d > {tdir}/{name}\" && " \
+                  f"{chmod} +x {tdir}/{name}"
+        if not force:
+            install = f"([ -x {tdir}/{name} ] && {sha1sum} {tdir}/{name} | grep -q ^{digest}) || ({install})"
+        remote_run(host, install, alternative=False)
 
     parallel_map(hosts, install_to_host)
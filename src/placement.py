@@ -0,0 +1,124 @@
+import re
+import itertools
+from typing import Dict, List, Optional, Any, Tuple
+from .config import config
+from .parallel_map import parallel_map_dict
+from .detect_gpus import get_gpu_inventory, get_host_topology, get_free_gpus_from_inventory
+
+# Placement of runs on the GPUs of the SSH hosts. GPUs are ranked by model, free memory and utilization, multi-GPU
+# runs get groups of GPUs with the fastest interconnect available on the host, and the hosts are filled according
+# to the policy:
+#   pack: fill the best hosts first, using as few hosts as possible
+#   spread: distribute the runs evenly among the hosts
+
+LINK_SCORES = {"PIX": 5, "PXB": 4, "PHB": 3, "NODE": 2, "SOC": 2, "SYS": 1}
+
+# Don't try all combinations of GPUs for groups if a host has more free GPUs than this.
+MAX_EXHAUSTIVE_GROUP_SEARCH = 12
+
+
+def normalize_name(name: str) -> str:
+    return re.sub("[^0-9a-z]", "", name.lower())
+
+
+def is_type_enabled(gpu: Dict[str, Any]) -> bool:
+    if config.enabled_gpu_types is None:
+        return True
+
+    name = normalize_name(gpu.get("name") or "")
+    return any(normalize_name(t) in name for t in config.enabled_gpu_types)
+
+
+def get_model_score(gpu: Dict[str, Any]) -> float:
+    # The position in the placement/gpu_priority list if defined, otherwise the total memory as a proxy.
+    priority = config.get("placement", {}).get("gpu_priority")
+    if priority:
+        name = normalize_name(gpu.get("name") or "")
+        for i, p in enumerate(priority):
+            if normalize_name(p) in name:
+                return len(priority) - i
+        return 0
+
+    return gpu.get("memory_total") or 0
+
+
+def get_gpu_score(gpu: Dict[str, Any]) -> Tuple:
+    total = gpu.get("memory_total")
+    used = gpu.get("memory_used")
+    free_fraction = (total - used) / total if total and used is not None else 0
+    return get_model_score(gpu), free_fraction, -(gpu.get("utilization") or 0)
+
+
+def get_link_score(topology: Optional[Dict[str, Dict[str, str]]], a: int, b: int) -> int:
+    link = (topology or {}).get(str(a), {}).get(str(b), "")
+    if link.startswith("NV"):
+        # NVLink, the number is the number of links
+        return 100 + int(link[2:] or 0)
+    return LINK_SCORES.get(link, 0)
+
+
+def get_group_score(gpus: List[Dict[str, Any]], topology) -> Tuple:
+    link = min((get_link_score(topology, a["index"], b["index"]) for a, b in itertools.combinations(gpus, 2)),
+               default=0)
+    scores = [get_gpu_score(g) for g in gpus]
+    return (link,) + tuple(sum(s[i] for s in scores) for i in range(len(scores[0])))
+
+
+def find_groups(gpus: List[Dict[str, Any]], size: int, topology) -> List[Tuple[Tuple, List[int]]]:
+    # Splits the free GPUs of a host to groups of the given size, best group first.
+    gpus = sorted(gpus, key=get_gpu_score, reverse=True)
+    groups = []
+    while len(gpus) >= size:
+        if size == 1 or len(gpus) > MAX_EXHAUSTIVE_GROUP_SEARCH:
+            best = gpus[:size]
+        else:
+            best = max(itertools.combinations(gpus, size), key=lambda g: get_group_score(list(g), topology))
+
+        groups.append((get_group_score(list(best), topology), [g["index"] for g in best]))
+        gpus = [g for g in gpus if g not in best]
+
+    return groups
+
+
+def get_free_groups(host: str, gpus: Optional[List[Dict[str, Any]]], gpu_per_run: int,
+                    ignore_used: bool) -> List[Tuple[Tuple, List[int]]]:
+    free = set(get_free_gpus_from_inventory(host, gpus, ignore_used) or [])
+    gpus = [g for g in gpus or [] if g["index"] in free and is_type_enabled(g)]
+    topology = get_host_topology(host) if gpu_per_run > 1 and len(gpus) >= gpu_per_run else None
+    return find_groups(gpus, gpu_per_run, topology)
+
+
+def place_runs(n_runs: Optional[int], gpu_per_run: int = 1, ignore_used: bool = False,
+               policy: Optional[str] = None) -> Dict[str, List[int]]:
+    # Returns the GPUs to use on each host. The GPUs of a multi-GPU run are consecutive in the list.
+    policy = policy or config.get("placement", {}).get("policy", "pack")
+    assert policy in {"pack", "spread"}, f"Invalid placement policy: {policy}"
+
+    inventory = get_gpu_inventory()
+    groups = parallel_map_dict(list(inventory.keys()),
+                               lambda h: get_free_groups(h, inventory[h], gpu_per_run, ignore_used))
+    groups = {h: g for h, g in groups.items() if g}
+    if n_runs is None:
+        n_runs = sum(len(g) for g in groups.values())
+
+    host_order = {h: i for i, h in enumerate(config["hosts"])}
+    use_gpus = {}
+    n_used = 0
+
+    if policy == "pack":
+        hosts = sorted(groups.keys(), key=lambda h: (groups[h][0][0][1:], len(groups[h]), -host_order[h]),
+                       reverse=True)
+        for host in hosts:
+            for _, g in groups[host][:n_runs - n_used]:
+                use_gpus[host] = use_gpus.get(host, []) + g
+                n_used += 1
+    else:
+        while n_used < n_runs and any(groups.values()):
+            # Take the best group from the least loaded hosts
+            n_on_host = lambda h: len(use_gpus.get(h, []))
+            host = max((h for h, g in groups.items() if g),
+                       key=lambda h: (-n_on_host(h), groups[h][0][0], -host_order[h]))
+            use_gpus[host] = use_gpus.get(host, []) + groups[host].pop(0)[1]
+            n_used += 1
+
+    return {h: use_gpus[h] for h in config["hosts"] if h in use_gpus}
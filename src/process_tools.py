@@ -1,13 +1,21 @@
 import subprocess
-from .parallel_map import parallel_map_dict
+import asyncio
+from .parallel_map import parallel_map_dict, parallel_iter, MAX_WORKERS
 import socket
 import re
 from .config import config
 import os
 from .utils import *
-from threading import Semaphore, Lock
-from typing import Optional
+from .ssh_pool import connection_pool
+from .cache import JSONCache
+from threading import Semaphore, Lock, Event, Timer
+from typing import Optional, List, Dict, Callable
 import base64
+import json
+import hashlib
+import atexit
+import signal
+import time
 
 
 DEBUG = False
@@ -32,21 +40,146 @@ class HostCallLimiter:
     def __exit__(self ,type, value, traceback):
         HostCallLimiter.host_semaphores[self.host].release()
 
+    async def __aenter__(self):
+        # The same limit for the async engine. Polls, so that the event loop is never blocked.
+        while not HostCallLimiter.host_semaphores[self.host].acquire(blocking=False):
+            await asyncio.sleep(0.01)
 
-def run_process(command, get_stderr=False, input: Optional[str] = None):
+    async def __aexit__(self, type, value, traceback):
+        HostCallLimiter.host_semaphores[self.host].release()
+
+
+# Return code of commands killed because of a timeout (same as of coreutils timeout)
+TIMEOUT_ERRCODE = 124
+
+# Return code of ssh if it fails to connect or authenticate
+SSH_ERRCODE = 255
+
+# Functions called with the host name when ssh fails. If any of them returns True (e.g. it refreshed an expired key),
+# the command is retried once.
+auth_failure_handlers: List[Callable[[str], bool]] = []
+
+
+def should_retry(host: str, errcode: int) -> bool:
+    # Whether a remote command should be run again, because ssh failed and the cause was fixed. Used by both engines.
+    return errcode == SSH_ERRCODE and not is_local(host) and any(h(host) for h in auth_failure_handlers)
+
+MAX_STREAM_LINE = 64 * 1024
+
+# Process groups of the commands started with a timeout. They are started in a new session, so that the whole
+# group can be killed on timeout, but then they don't receive Ctrl-C from the terminal, so kill them on exit.
+timed_process_groups = set()
+
+
+@atexit.register
+def kill_timed_process_groups():
+    for pgid in list(timed_process_groups):
+        kill_process_group(pgid)
+
+
+def kill_process_group(pgid: int):
+    try:
+        os.killpg(pgid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def get_timeout(host: str, timeout: Optional[float] = None, deadline: Optional[float] = None) -> Optional[float]:
+    # The timeout for a single command on host: the smallest of the explicit timeout, the configured timeout of the
+    # host, and the time remaining until the deadline (absolute time.time()).
+    timeouts = config.get("timeouts", {})
+    timeouts = [timeout, timeouts.get(host, timeouts.get("all"))]
+    if deadline is not None:
+        timeouts.append(max(deadline - time.time(), 0))
+
+    timeouts = [t for t in timeouts if t is not None]
+    return min(timeouts) if timeouts else None
+
+
+def get_deadline(host: str, timeout: Optional[float] = None, deadline: Optional[float] = None) -> Optional[float]:
+    # Same as get_timeout, but as an absolute time, so that it covers the setup of the connection as well.
+    timeout = get_timeout(host, timeout, deadline)
+    return None if timeout is None else time.time() + timeout
+
+
+def run_process(command, get_stderr=False, input: Optional[str] = None, timeout: Optional[float] = None):
     if DEBUG:
         print("RUN: ", command)
+
+    if timeout is not None and timeout <= 0:
+        return ("", "", TIMEOUT_ERRCODE) if get_stderr else ("", TIMEOUT_ERRCODE)
+
     proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE if get_stderr else None,
-                            shell=True, stdin=subprocess.PIPE)
-    res = proc.communicate(input.encode() if input is not None else None)
+                            shell=True, stdin=subprocess.PIPE, start_new_session=timeout is not None)
+
+    if timeout is not None:
+        timed_process_groups.add(proc.pid)
+
+    try:
+        res = proc.communicate(input.encode() if input is not None else None, timeout=timeout)
+        returncode = proc.returncode
+    except subprocess.TimeoutExpired:
+        kill_process_group(proc.pid)
+        # Return the partial output
+        res = proc.communicate()
+        returncode = TIMEOUT_ERRCODE
+    finally:
+        timed_process_groups.discard(proc.pid)
+
     stdout = res[0].decode()
     if get_stderr:
         stderr = res[1].decode()
-        return stdout, stderr, proc.returncode
+        return stdout, stderr, returncode
     else:
-        return stdout, proc.returncode
+        return stdout, returncode
+
+def stream_process(command, on_line: Callable[[str], None], input: Optional[str] = None,
+                   timeout: Optional[float] = None) -> int:
+    # Like run_process, but calls on_line for every line of the output (stdout and stderr merged) as it arrives,
+    # instead of collecting it in memory. Lines longer than MAX_STREAM_LINE are split.
+    if DEBUG:
+        print("RUN: ", command)
+
+    if timeout is not None and timeout <= 0:
+        return TIMEOUT_ERRCODE
+
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True,
+                            stdin=subprocess.PIPE, start_new_session=timeout is not None)
+
+    timed_out = Event()
+    timer = None
+    if timeout is not None:
+        timed_process_groups.add(proc.pid)
+
+        def on_timeout():
+            timed_out.set()
+            kill_process_group(proc.pid)
 
-def remote_run(host, command, alternative=True, root_password: Optional[str] = None, add_sudo = True):
+        timer = Timer(timeout, on_timeout)
+        timer.start()
+
+    try:
+        try:
+            if input is not None:
+                proc.stdin.write(input.encode())
+            proc.stdin.close()
+        except OSError:
+            pass
+
+        for line in iter(lambda: proc.stdout.readline(MAX_STREAM_LINE), b""):
+            on_line(line.decode(errors="replace").rstrip("\n"))
+
+        returncode = proc.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+            timed_process_groups.discard(proc.pid)
+
+    return TIMEOUT_ERRCODE if timed_out.is_set() else returncode
+
+
+def get_host_command(host, command, alternative=True, root_password: Optional[str] = None, add_sudo = True) -> str:
+    # The command to run on the host itself, with the configured commands, environment, path and prefix.
     # command = command.replace("'", "'\"'\"'")
     if alternative:
         commands = [c.strip() for c in command.split(";") if c]
@@ -82,43 +215,215 @@ def remote_run(host, command, alternative=True, root_password: Optional[str] = N
     command = env+" "+command
 
     if "'" in command:
-        # Avoid the impossible task of figuring out how to escape the string.
-        command = f"echo {base64.b64encode(command.encode()).decode()}|base64 -d|bash"
+        # Avoid the impossible task of figuring out how to escape the string. Don't pipe it to bash, because then
+        # the stdin of the command would not be usable.
+        command = f"bash -c \"$(echo {base64.b64encode(command.encode()).decode()}|base64 -d)\""
+
+    return command
+
 
+def get_remote_command(host, command, alternative=True, root_password: Optional[str] = None, add_sudo = True,
+                       deadline: Optional[float] = None) -> str:
+    command = get_host_command(host, command, alternative, root_password, add_sudo)
     if not is_local(host):
-        flags = config.get_ssh_flags(host)
-        command = f"ssh {flags}"+(" -tt" if root_password else "")+" "+host+" '"+command+"'"
+        ssh = connection_pool.get_ssh_command(host, deadline)
+        command = ssh+(" -tt" if root_password else "")+" "+host+" '"+command+"'"
+
+    return command
+
+
+def remote_run(host, command, alternative=True, root_password: Optional[str] = None, add_sudo = True,
+               timeout: Optional[float] = None, deadline: Optional[float] = None, input: Optional[str] = None):
+    end = get_deadline(host, timeout, deadline)
+    command = get_remote_command(host, command, alternative, root_password, add_sudo, end)
+    if root_password:
+        input = root_password + "\n" + (input or "")
 
     with HostCallLimiter(host):
-        stdout, errcode = run_process(command, input=(root_password + "\n") if root_password else None)
+        stdout, errcode = run_process(command, input=input, timeout=get_timeout(host, None, end))
+        if should_retry(host, errcode):
+            stdout, errcode = run_process(command, input=input, timeout=get_timeout(host, None, end))
+
         if root_password:
             stdout=stdout.replace(root_password, "")
         return stdout, errcode
 
 
-def run_multiple_hosts(hosts, command, relative=True, alternative=True, root_password: Optional[str] = None):
-    dir = get_relative_path()
+# Output of idempotent remote commands (expanded paths, usernames, ...)
+remote_facts = JSONCache("remote_facts")
+checked_fact_hosts = set()
+facts_mutex = Lock()
+
+
+def get_host_config_digest(host) -> str:
+    # The parts of the config changing what the commands on the host do.
+    relevant = {k: config.get(k, {}).get(host) for k in ["commands", "envs", "paths", "prefix_command", "bin_dir",
+                                                           "slurm"]}
+    relevant.update(all_commands=config.get("commands", {}).get("all"), all_envs=config.get("envs", {}).get("all"),
+                    path=config.get("path"))
+    return hashlib.sha1(json.dumps(relevant, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def check_remote_facts(host):
+    # Drops the facts of the host if its config changed since they were cached. Once per invocation.
+    with facts_mutex:
+        if host in checked_fact_hosts:
+            return
+        checked_fact_hosts.add(host)
+
+    digest = get_host_config_digest(host)
+    if remote_facts.peek(f"{host}:config")[0] != digest:
+        invalidate_remote_facts(host)
+
+
+def cached_remote_run(host, command, ttl: Optional[float] = None, alternative=True) -> Optional[str]:
+    # For commands whose output doesn't change, or changes rarely. The stdout is cached on disk for ttl seconds
+    # (remote_facts_ttl by default), keyed by the host and the command, and ignored with --refresh. Returns None if
+    # the command fails. Failures are not cached, and they drop all the facts of the host, as something changed.
+    if ttl is None:
+        ttl = config.get("remote_facts_ttl", 7 * 24 * 3600)
+
+    check_remote_facts(host)
+    key = f"{host}:{hashlib.sha1(command.encode()).hexdigest()}"
+    stdout = remote_facts.get(key, ttl)
+    if stdout is not None:
+        return stdout
+
+    stdout, ret = remote_run(host, command, alternative)
+    if ret != 0:
+        invalidate_remote_facts(host)
+        return None
+
+    remote_facts.set(key, stdout)
+    return stdout
+
+
+def invalidate_remote_facts(host: str):
+    remote_facts.invalidate_prefix(host + ":")
+    remote_facts.set(f"{host}:config", get_host_config_digest(host))
+
+
+def get_multi_host_command(host, command, relative=True, root_password: Optional[str] = None) -> str:
+    cd = config.get_command(host, "cd")
+
+    if root_password:
+        command = "sudo "+command
+
+    if relative:
+        command = cd + " " + get_relative_path() + " 2>/dev/null; " + command
+
+    return command
+
+
+def use_async_engine(hosts) -> bool:
+    engine = config.get("engine", "auto")
+    if engine == "auto":
+        return len(hosts) > MAX_WORKERS
+    return engine == "async"
+
+
+def iter_multiple_hosts(hosts, command, relative=True, alternative=True, root_password: Optional[str] = None,
+                        timeout: Optional[float] = None, deadline: Optional[float] = None):
+    # Yields (host, (stdout, errcode)) as the hosts finish. Commands running longer than timeout seconds, or not
+    # finished until the deadline (absolute time.time()), are killed and return TIMEOUT_ERRCODE with their partial
+    # output.
+    hosts = list(hosts)
+    if use_async_engine(hosts):
+        # Imported here, because async_process depends on this module.
+        from . import async_process
+        yield from async_process.iter_multiple_hosts(hosts, command, relative, alternative, root_password, timeout,
+                                                     deadline)
+        return
 
     def run_it(host):
-        cd = config.get_command(host, "cd")
+        cmd = get_multi_host_command(host, command, relative, root_password)
+        return remote_run(host, cmd, alternative=alternative, root_password=root_password, add_sudo=False,
+                          timeout=timeout, deadline=deadline)
 
-        cmd = command
-        if root_password:
-            cmd = "sudo "+cmd
+    # The hosts not finished by the deadline (e.g. stuck before running the command) are reported as timed out.
+    for host, res in parallel_iter(hosts, run_it, ordered=False, deadline=deadline, return_exceptions=True):
+        if isinstance(res, TimeoutError):
+            res = ("", TIMEOUT_ERRCODE)
+        elif isinstance(res, BaseException):
+            raise res
+        yield host, res
+
+
+def remote_stream(host, command, on_line: Callable[[str], None], alternative=True,
+                  root_password: Optional[str] = None, add_sudo = True, timeout: Optional[float] = None,
+                  deadline: Optional[float] = None) -> int:
+    end = get_deadline(host, timeout, deadline)
+    command = get_remote_command(host, command, alternative, root_password, add_sudo, end)
+
+    def filter_line(line):
+        on_line(line.replace(root_password, "") if root_password else line)
+
+    with HostCallLimiter(host):
+        return stream_process(command, filter_line, input=(root_password + "\n") if root_password else None,
+                              timeout=get_timeout(host, None, end))
+
+
+def stream_multiple_hosts(hosts, command, relative=True, alternative=True, root_password: Optional[str] = None,
+                          timeout: Optional[float] = None, deadline: Optional[float] = None,
+                          tee_dir: Optional[str] = None) -> Dict[str, int]:
+    # Runs the command on all hosts and prints their output interleaved, line by line, prefixed by the host name.
+    # If tee_dir is given, the full output of each host is also written to tee_dir/<host>.log. Returns the error
+    # codes.
+    hosts = list(hosts)
+    print_lock = Lock()
+    width = max(len(h) for h in hosts) if hosts else 0
+
+    if tee_dir:
+        os.makedirs(tee_dir, exist_ok=True)
+
+    def run_it(host):
+        tee = open(os.path.join(tee_dir, host + ".log"), "w") if tee_dir else None
+
+        def on_line(line):
+            with print_lock:
+                print(f"{host:<{width}} | {line}", flush=True)
+            if tee is not None:
+                tee.write(line + "\n")
+
+        try:
+            cmd = get_multi_host_command(host, command, relative, root_password)
+            return remote_stream(host, cmd, on_line, alternative=alternative, root_password=root_password,
+                                 add_sudo=False, timeout=timeout, deadline=deadline)
+        finally:
+            if tee is not None:
+                tee.close()
+
+    res = parallel_map_dict(hosts, run_it, deadline=deadline, return_exceptions=True)
+    for host, r in res.items():
+        if isinstance(r, TimeoutError):
+            res[host] = TIMEOUT_ERRCODE
+        elif isinstance(r, BaseException):
+            raise r
+    return res
+
+
+def run_multiple_hosts(hosts, command, relative=True, alternative=True, root_password: Optional[str] = None,
+                       timeout: Optional[float] = None, deadline: Optional[float] = None):
+    hosts = list(hosts)
+    res = dict(iter_multiple_hosts(hosts, command, relative, alternative, root_password, timeout, deadline))
+    return {h: res[h] for h in hosts}
 
-        if relative:
-            cmd = cd + " " + dir + " 2>/dev/null; " + cmd        
 
-        return remote_run(host, cmd, alternative=alternative, root_password=root_password, add_sudo=False)
+def get_timed_out_hosts(results) -> List[str]:
+    return [h for h, (_, err) in results.items() if err == TIMEOUT_ERRCODE]
 
-    return parallel_map_dict(hosts, run_it)
 
+def run_multiple_on_multiple(hosts, command, root_password: Optional[str] = None, timeout: Optional[float] = None,
+                             deadline: Optional[float] = None):
+    hosts = list(hosts)
+    if use_async_engine(hosts):
+        from . import async_process
+        return async_process.run_multiple_on_multiple(hosts, command, root_password, timeout, deadline)
 
-def run_multiple_on_multiple(hosts, command, root_password: Optional[str] = None):
     def run_commands(host):
         out=[]
         for c in command:
-            stdout, err = remote_run(host, c, root_password=root_password)
+            stdout, err = remote_run(host, c, root_password=root_password, timeout=timeout, deadline=deadline)
             if err!=0:
                 print("WARNING: command %s failed on host %s" % (c, host))
                 return (out, err)
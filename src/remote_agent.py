@@ -0,0 +1,154 @@
+import atexit
+import json
+import os
+import select
+import subprocess
+import time
+from threading import Lock
+from typing import Any, Dict, Optional
+from .config import config
+from .payload import send_payload, get_bindir
+from . import process_tools
+
+# Must match VERSION in payloads/ct_agent.py. Bump it when changing the protocol, so that outdated agents are
+# reinstalled automatically.
+AGENT_VERSION = 7
+AGENT_NAME = "ct_agent.py"
+
+
+class RemoteAgentError(Exception):
+    pass
+
+
+class RemoteAgent:
+    # A long-lived helper process on a remote host speaking a line-based JSON protocol over a single SSH session.
+    # Note: it permanently uses one channel of the host's persistent SSH connection.
+
+    def __init__(self, host: str, deadline: Optional[float] = None):
+        self.host = host
+        self.lock = Lock()
+        self.next_id = 0
+
+        python = config.get_command(host, "python3")
+        cmd = process_tools.get_remote_command(host, f"{python} {get_bindir(host)}/{AGENT_NAME}", alternative=False)
+        if process_tools.DEBUG:
+            print("RUN: ", cmd)
+
+        self.proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL)
+        self.buffer = b""
+
+        hello = self.read(process_tools.get_deadline(host, None, deadline))
+        if hello.get("version") != AGENT_VERSION:
+            self.close()
+            raise RemoteAgentError(f"Agent version mismatch on {host}: {hello.get('version')}")
+
+    def read(self, end: Optional[float]) -> Dict[str, Any]:
+        # Waits for the next response until the absolute time end (forever if None).
+        while b"\n" not in self.buffer:
+            ready, _, _ = select.select([self.proc.stdout], [], [], None if end is None else max(end - time.time(), 0))
+            if not ready:
+                self.kill()
+                raise RemoteAgentError(f"Agent on {self.host} timed out")
+
+            data = os.read(self.proc.stdout.fileno(), 65536)
+            if not data:
+                self.close()
+                raise RemoteAgentError(f"Agent on {self.host} exited")
+            self.buffer += data
+
+        line, _, self.buffer = self.buffer.partition(b"\n")
+
+        try:
+            return json.loads(line)
+        except ValueError:
+            self.close()
+            raise RemoteAgentError(f"Invalid response from the agent on {self.host}: {line}")
+
+    def call(self, op: str, deadline: Optional[float] = None, **args) -> Any:
+        # Limited by the timeout of the host and the deadline, like remote_run.
+        end = process_tools.get_deadline(self.host, None, deadline)
+        with self.lock:
+            if self.proc.poll() is not None:
+                raise RemoteAgentError(f"Agent on {self.host} is not running")
+
+            self.next_id += 1
+            try:
+                self.proc.stdin.write((json.dumps({"id": self.next_id, "op": op, "args": args}) + "\n").encode())
+                self.proc.stdin.flush()
+            except OSError:
+                self.close()
+                raise RemoteAgentError(f"Agent on {self.host} exited")
+
+            res = self.read(end)
+
+        if "error" in res:
+            raise RemoteAgentError(f"{op} failed on {self.host}: {res['error']}")
+        return res["result"]
+
+    def close(self):
+        if self.proc.poll() is None:
+            self.proc.stdin.close()
+            try:
+                self.proc.wait(5)
+            except subprocess.TimeoutExpired:
+                self.kill()
+
+    def kill(self):
+        # Unresponsive. The pending response would be mistaken for the next one, so the agent can't be used anymore.
+        if self.proc.poll() is None:
+            self.proc.kill()
+            self.proc.wait()
+
+
+agents: Dict[str, Optional[RemoteAgent]] = {}
+agents_mutex = Lock()
+host_locks: Dict[str, Lock] = {}
+
+
+def start_agent(host: str, deadline: Optional[float] = None) -> Optional[RemoteAgent]:
+    # Both attempts together are limited by the timeout of the host.
+    deadline = process_tools.get_deadline(host, None, deadline)
+    try:
+        return RemoteAgent(host, deadline)
+    except RemoteAgentError:
+        pass
+
+    # Not installed or outdated.
+    send_payload([host], AGENT_NAME, force=True)
+    try:
+        return RemoteAgent(host, deadline)
+    except RemoteAgentError:
+        print(f"WARNING: failed to start helper agent on {host}. Falling back to shell commands.")
+        return None
+
+
+def get_agent(host: str, deadline: Optional[float] = None) -> Optional[RemoteAgent]:
+    if not config.get("remote_agent", True):
+        return None
+
+    with agents_mutex:
+        if host not in host_locks:
+            host_locks[host] = Lock()
+        lock = host_locks[host]
+
+    with lock:
+        if host not in agents:
+            agents[host] = start_agent(host, deadline)
+        return agents[host]
+
+
+def call(host: str, op: str, deadline: Optional[float] = None, **args) -> Any:
+    # Raises RemoteAgentError if the agent is unavailable, the request fails or times out. The caller should fall
+    # back to the shell-based implementation in this case.
+    agent = get_agent(host, deadline)
+    if agent is None:
+        raise RemoteAgentError(f"No agent running on {host}")
+    return agent.call(op, deadline, **args)
+
+
+@atexit.register
+def close_all():
+    for a in agents.values():
+        if a is not None:
+            a.close()
@@ -1,39 +1,78 @@
 from typing import Dict, List, Optional
 from .parallel_map import parallel_map_dict, parallel_map
 from .config import config
-from .process_tools import remote_run
+from .process_tools import remote_run, cached_remote_run, get_host_command
+from . import remote_agent
+from .remote_agent import RemoteAgentError
 import getpass
 
 
 def get_usernames() -> List[str]:
     def get_name(host: str) -> str:
         whoami = config.get_command(host, "whoami")
-        stdout, ret = remote_run(host, whoami)
-        return stdout.strip() if ret == 0 else None
+        stdout = cached_remote_run(host, whoami)
+        return stdout.strip() if stdout is not None else None
 
     return parallel_map_dict(config["hosts"], get_name)
 
 
+def start_detached(host: str, command: str, alternative=True) -> int:
+    # Starts a command which detaches itself (e.g. screen -d -m) and returns its exit code. Through the agent if
+    # possible, so no new ssh session is needed for each command.
+    try:
+        res = remote_agent.call(host, "spawn", cmd=get_host_command(host, command, alternative), wait=10)
+        # Still running: it didn't detach, but it started.
+        return res["returncode"] or 0
+    except RemoteAgentError:
+        pass
+
+    return remote_run(host, command, alternative)[1]
+
+
+def remote_exists(host: str, path: str) -> bool:
+    # Whether path (relative to the home directory) exists on the host.
+    try:
+        return remote_agent.call(host, "stat", path=path)["exists"]
+    except RemoteAgentError:
+        pass
+
+    _, errcode = remote_run(host, f"ls -d {path} 2>/dev/null")
+    return errcode == 0
+
+
 def kill_pids(pids: Dict[str, List[int]], root_password: Optional[str] = None, gpid=False):
     def do_kill(args):
-        host, pids = args
+        host, p = args
         kill = config.get_command(host, "kill")
-        for p in pids:
-            print("Killing", p)
-            remote_run(host, f"{kill} {' -- -' if gpid else ''}{p}", root_password=root_password)
+        print("Killing", p)
+        if root_password is None:
+            try:
+                remote_agent.call(host, "kill", pid=int(p), group=gpid)
+                return
+            except RemoteAgentError:
+                pass
 
-    return parallel_map([(k, v) for k, v in pids.items()], do_kill)
+        remote_run(host, f"{kill} {' -- -' if gpid else ''}{p}", root_password=root_password)
+
+    return parallel_map([(k, p) for k, v in pids.items() for p in v], do_kill)
 
 
 def find_phantom_processes() -> Dict[str, List[str]]:
     def find_dead(host: str) -> List[str]:
         ps = config.get_command(host, "ps")
 
-        stdout, ret = remote_run(host, f"{ps} -o user,pgid,ppid,cmd -e")
-        lines = [[w.strip() for w in l.split(" ") if w] for l in stdout.split("\n")]
-        lines = [l for l in lines if l]
+        try:
+            processes = remote_agent.call(host, "ps", ps=ps)
+            # Only the executable is matched, like with the output of ps below.
+            parentless = [(p["user"], str(p["pgid"]), (p["cmd"].split() or [""])[0]) for p in processes
+                          if p["ppid"] == 1]
+        except RemoteAgentError:
+            stdout, ret = remote_run(host, f"{ps} -o user,pgid,ppid,cmd -e")
+            lines = [[w.strip() for w in l.split(" ") if w] for l in stdout.split("\n")]
+            lines = [l for l in lines if l]
+
+            parentless = [(l[0], l[1], l[3]) for l in lines[1:] if l[2] == "1"]
 
-        parentless = [(l[0], l[1], l[3]) for l in lines[1:] if l[2] == "1"]
         parentless_python = [p for p in parentless if "python" in p[2] and p[0]!="root"]
 
         by_pgid = {}
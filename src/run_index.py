@@ -0,0 +1,117 @@
+import os
+from typing import Dict, List, Optional, Any, Tuple
+from .config import config
+from .cache import JSONCache
+from .process_tools import remote_run
+from .parallel_map import parallel_map_dict
+from .utils import quote_remote_path
+from . import remote_agent
+from .remote_agent import RemoteAgentError
+
+# Index of the W&B run directories on the hosts: {directory name: [last modified in ms, latest checkpoint]}, where the
+# checkpoint is relative to the runs directory (None if there is none). It is updated incrementally with the agent:
+# only the directories modified since the last time are listed again.
+
+INDEX_SEPARATOR = "----"
+
+run_index_cache = JSONCache("run_index")
+
+
+def get_ckpt_layout() -> Tuple[str, Optional[str]]:
+    # Splits wandb_ckpt_path (e.g. wandb/*${id}*/files/checkpoint) to the runs directory relative to the project and
+    # the checkpoint directory relative to the run directory.
+    parts = config.get("wandb_ckpt_path", "wandb/*${id}*/files/checkpoint").split("/")
+    for i, p in enumerate(parts):
+        if "${id}" in p:
+            return "/".join(parts[:i]) or ".", "/".join(parts[i + 1:]) or None
+    return "wandb", None
+
+
+def get_run_id(dirname: str) -> str:
+    # run-20230101_120000-<id>, offline-run-20230101_120000-<id>
+    return dirname.split("-")[-1]
+
+
+def get_remote_dir(local_dir: str) -> str:
+    # Path on the remote hosts of a local directory within the home directory.
+    return "~/" + os.path.relpath(os.path.abspath(local_dir), os.path.expanduser("~"))
+
+
+def index_with_shell(host: str, path: str, ckpt: Optional[str]) -> Optional[Dict[str, List[Any]]]:
+    # Lists the directories and all checkpoints in a single command. Not incremental.
+    cmd = f"cd {quote_remote_path(path)} && find . -mindepth 1 -maxdepth 1 -type d -printf '%f\\t%T@\\n'"
+    if ckpt:
+        depth = len(ckpt.split("/")) + 2
+        cmd += f" && echo {INDEX_SEPARATOR} && find . -mindepth {depth} -maxdepth {depth} " \
+               f"-path {quote_remote_path('./*/' + ckpt + '/*')} -type f -printf '%P\\t%T@\\n'"
+
+    stdout, ret = remote_run(host, cmd + " 2>/dev/null", alternative=False)
+    if ret != 0:
+        return None
+
+    dirs, _, ckpts = stdout.partition(INDEX_SEPARATOR + "\n")
+    res = {}
+    for l in dirs.split("\n"):
+        name, _, mtime = l.partition("\t")
+        if name and mtime and not name.startswith("."):
+            res[name] = [int(float(mtime) * 1000), None]
+
+    newest = {}
+    for l in ckpts.split("\n"):
+        file, _, mtime = l.partition("\t")
+        name = file.split("/")[0]
+        if not mtime or name not in res:
+            continue
+
+        mtime = int(float(mtime) * 1000)
+        if mtime >= newest.get(name, -1):
+            newest[name] = mtime
+            res[name] = [max(res[name][0], mtime), file]
+
+    return res
+
+
+def get_host_run_index(host: str, path: str, ckpt: Optional[str] = None) -> Optional[Dict[str, List[Any]]]:
+    # Returns the index of the runs directory path (relative to the home directory) on the host, or None if it
+    # doesn't exist or can't be read. The checkpoints are looked up in the ckpt subdirectory of the runs, if given.
+    key = f"{host}:{path}:{ckpt}"
+    known = run_index_cache.get(key) or {}
+
+    try:
+        res = remote_agent.call(host, "run_index", path=path, ckpt_path=ckpt,
+                                known={k: v[0] for k, v in known.items()})
+        if res is not None:
+            res = {n: res["changed"][n] if n in res["changed"] else known[n] for n in res["names"]}
+    except RemoteAgentError:
+        res = index_with_shell(host, path, ckpt)
+
+    if res is None:
+        run_index_cache.invalidate(key)
+    else:
+        run_index_cache.set(key, res)
+    return res
+
+
+def get_run_index(paths: Dict[str, str], ckpt: Optional[str] = None) -> \
+        Dict[str, Dict[str, List[Tuple[str, int, Optional[str]]]]]:
+    # Indexes the runs directory given for each host, with one round-trip per host. Returns
+    # {host: {run id: [(run dir, last modified in ms, checkpoint), ...]}}, where the run dir and the checkpoint are
+    # relative to the runs directory. A run can have multiple directories if it was resumed.
+    def index_host(host: str) -> Dict[str, List[Tuple[str, int, Optional[str]]]]:
+        res = {}
+        for name, (mtime, c) in sorted((get_host_run_index(host, paths[host], ckpt) or {}).items()):
+            res.setdefault(get_run_id(name), []).append((name, mtime, c))
+        return res
+
+    return parallel_map_dict(paths.keys(), index_host)
+
+
+def find_runs(index: Dict[str, Dict[str, List[Tuple[str, int, Optional[str]]]]], run_ids: Optional[List[str]] = None) \
+        -> Dict[str, List[Tuple[str, str, int, Optional[str]]]]:
+    # Looks up runs in the index of many hosts. Returns {run id: [(host, run dir, last modified, checkpoint), ...]}.
+    res = {}
+    for host, runs in index.items():
+        for id in (runs.keys() if run_ids is None else run_ids):
+            for d in runs.get(id, []):
+                res.setdefault(id, []).append((host,) + tuple(d))
+    return res
@@ -1,5 +1,6 @@
 from .parallel_map import parallel_map_dict
 from .process_tools import remote_run
+from .remote_process import start_detached
 from .utils import *
 from .config import config
 import re
@@ -60,6 +61,6 @@ def run_in_screen(hosts, command, name = None, relative = True, env = ""):
         cmd = env + screen + " -d -S "+name+" -m "+command
         if relative:
             cmd = cd + " " + dir + "; " + cmd
-        return remote_run(host, cmd)
+        return start_detached(host, cmd)
 
     return parallel_map_dict(hosts, run), name
\ No newline at end of file
@@ -1,10 +1,10 @@
 from .process_tools import run_multiple_on_multiple, remote_run
+from .remote_process import remote_exists
 from .config import config
 from .parallel_map import parallel_map
 
 def do_env_setup(host):
-    res, errcode = remote_run(host, "ls -d ~/.clustertool 2>/dev/null")
-    if errcode!=0:
+    if not remote_exists(host, "~/.clustertool"):
         res, errcode = remote_run(host, "mkdir -p ~/.clustertool/bin")
         if errcode!=0:
             print("Failed to create ~/.clustertool directory")
@@ -1,26 +1,39 @@
 import os
 import string
 import random
-from .utils import get_relative_path
+from .utils import get_relative_path, random_string
 from .config import config
-from .process_tools import remote_run
+from .process_tools import remote_run, cached_remote_run
 from .parallel_map import parallel_map
 from .payload import send_payload, get_bindir
-from typing import Optional, Set
+from typing import Optional, Set, List, Dict
 import datetime
 import math
-import wandb
 import datetime
 import subprocess
-import requests
 import json
-import pyotp
 import base64
+import shlex
+import time
+from threading import Lock
+from .cache import JSONCache
+from . import process_tools
+from . import run_index
 
 known_dirs = {}
 
+# The signed CSCS key, written by update_cscs_ssh_keys. The public part is a certificate with the expiry in it.
+CSCS_CERT_FILES = ["~/.ssh/id_rsa_cscs.pub", "~/.ssh/id_rsa_cscs-cert.pub"]
+
+# Result of the login checks, if the expiry of the key can't be determined.
+auth_cache = JSONCache("cscs_auth")
+auth_refresh_lock = Lock()
+# When this invocation refreshed the CSCS keys, if it did. They are refreshed at most once per invocation.
+keys_refreshed_at: Optional[float] = None
+
 
 def get_wandb_sweep_command_without_args(sweep_id):
+    import wandb
     api = wandb.Api()
     s = api.sweep(sweep_id)
     program = s.config["program"]
@@ -67,6 +80,13 @@ def get_slurm_target_full_path(hosts):
     return {h: get_target_dir(h) if tgtdirs[h] is not None else None for h in hosts}
 
 
+def get_slurm_runs_dirs(hosts):
+    # Directories of the W&B runs on the SLURM hosts, for the run index. The target paths are quoted for the shell.
+    runs_dir, _ = run_index.get_ckpt_layout()
+    tdirs = get_slurm_target_full_path(hosts)
+    return {h: os.path.normpath(os.path.join(d.replace("'", ""), runs_dir)) for h, d in tdirs.items() if d is not None}
+
+
 def get_slurm_target_dir(hosts):
     hosts = list(hosts)
     sc = config.get("slurm", {})
@@ -76,8 +96,8 @@ def get_slurm_target_dir(hosts):
         echo = config.get_command(host, "echo")
         tdir = config["slurm"][host]["target_dir"]
         if "$" in tdir:
-            stdout, ret = remote_run(host, f"{echo} {tdir}")
-            assert ret == 0
+            stdout = cached_remote_run(host, f"{echo} {tdir}")
+            assert stdout is not None
             tdir = stdout.strip()
 
         return tdir
@@ -95,6 +115,27 @@ def check_runtime(runtime: Optional[str]):
     for r in rc:
         assert r.isdigit()
 
+def get_runtime_seconds(runtime: str) -> int:
+    h, m, s = runtime.split(":")
+    return int(h) * 3600 + int(m) * 60 + int(s)
+
+
+def get_runs_per_task(agents_per_gpu: int) -> int:
+    # How many runs a single array task does: agents_per_gpu in parallel, each of them runs_per_task times.
+    return agents_per_gpu * config.runs_per_task
+
+
+def get_pack_command(cmd: str, agents_per_gpu: int, runtime: str, n_total: Optional[int]) -> str:
+    # Wraps the command of an array task in pack_runs.py if it should do multiple runs. Run i of the array gets
+    # CT_RUN_INDEX=i in its environment.
+    runs_per_task = get_runs_per_task(agents_per_gpu)
+    if runs_per_task == 1:
+        return cmd
+
+    return f"pack_runs.py {agents_per_gpu} {runs_per_task} {get_runtime_seconds(runtime)} {n_total or 0} " \
+           f"{shlex.quote(cmd)}"
+
+
 def get_cpu_and_mem(host):
     num_cpus = config.num_cpus
     memory = config.memory
@@ -119,8 +160,10 @@ def run_agent(sweep_id: str, count: Optional[int], n_runs: Optional[int], multi_
 
     client_command = get_wandb_sweep_command_without_args(sweep_id) if multi_gpu > 1 else ""
 
-    runs_for_count = int(math.ceil(count / agents_per_gpu)) if count else None
-    n_run = min(runs_for_count, n_runs) if count is not None and n_runs is not None else (runs_for_count or n_runs or 1)
+    # Each array task does runs_per_task runs when packing.
+    runs_per_task = get_runs_per_task(agents_per_gpu)
+    n_tasks = int(math.ceil(count / runs_per_task)) if count else None
+    n_run = min(n_tasks, n_runs) if count is not None and n_runs is not None else (n_tasks or n_runs or 1)
 
     wandb_env = config.get_wandb_env()
     assert wandb_env, "W&B API key is needed for staring a W&B swipe"
@@ -153,10 +196,12 @@ def run_agent(sweep_id: str, count: Optional[int], n_runs: Optional[int], multi_
 
         if count:
             # Count is handled by SLURM
-            cnt = f"1-{count}%{n_run}"
+            cnt = f"1-{n_tasks}%{n_run}"
             cmd = f"{cmd} --count 1"
         else:
             cnt = f"1-{n_run}"
+            if config.runs_per_task > 1:
+                cmd = f"{cmd} --count 1"
 
         if multi_gpu > 1:
             cmd = f"{bash} -ec 'if [[ $SLURM_PROCID -eq 0  && -z $SLURM_RESTART_COUNT ]]; then {cmd}; else {client_command}; fi'"
@@ -168,9 +213,7 @@ def run_agent(sweep_id: str, count: Optional[int], n_runs: Optional[int], multi_
 
         res = get_cpu_and_mem(host)
 
-        if agents_per_gpu != 1:
-            raise ValueError("agents_per_gpu != 1 not supported for stanford template")
-        
+        cmd = get_pack_command(cmd, agents_per_gpu, runtime, count)
         slurm_flags = get_slurm_flags(host, multi_gpu)
         
         cmd = f"{wandb_env} {env} {sbatch} --job-name={name} {account} {slurm_flags} {res} --time={runtime} --output {odir}/{name}.log --chdir={target_dir} --array={cnt}  {machine_exclude} {partition} {bindir}/not_srun {cmd}"
@@ -182,6 +225,8 @@ def run_agent(sweep_id: str, count: Optional[int], n_runs: Optional[int], multi_
         remote_run(host, cmd)
 
     install_helper()
+    if get_runs_per_task(agents_per_gpu) > 1:
+        send_payload(config["slurm"].keys(), "pack_runs.py")
     parallel_map(config.get("slurm", {}).keys(), run_agent)
 
 def get_machine_exclude_list(host, exclude = set()):
@@ -256,13 +301,39 @@ def get_slurm_flags(host, multi_gpu):
     return slurm_flags
 
 
+def get_resume_manifests(hosts: List[str], run_ids: List[str]) -> Dict[str, List[Dict[str, Optional[str]]]]:
+    # Decides which host resumes which run, and from which checkpoint, based on the run index of the hosts. A run
+    # goes to the host with its newest checkpoint. Runs without a checkpoint found are sent to all hosts, where
+    # resume_jobs.py looks for them again.
+    runs_dir, ckpt = run_index.get_ckpt_layout()
+    found = run_index.find_runs(run_index.get_run_index(get_slurm_runs_dirs(hosts), ckpt), run_ids)
+
+    res = {h: [] for h in hosts}
+    missing = []
+    for id in run_ids:
+        ckpts = [(mtime, host, c) for host, _, mtime, c in found.get(id, []) if c]
+        if ckpts:
+            _, host, c = max(ckpts)
+            res[host].append({"id": id, "ckpt": os.path.join(runs_dir, c)})
+        else:
+            missing.append(id)
+            for runs in res.values():
+                runs.append({"id": id, "ckpt": None})
+
+    if missing:
+        print(f"WARNING: no checkpoint found on the SLURM hosts for {len(missing)} runs: {', '.join(missing)}")
+    return res
+
+
 def resume(sweep_id: str, multi_gpu: Optional[int], agents_per_gpu: Optional[int], runtime: Optional[str],
            force: bool, force2: bool, exclude_machines: Set[str]):
     if not config.get("slurm"):
         return
 
+    import wandb
     sweep = wandb.Api().sweep(sweep_id)
     r_to_start = [r for r in sweep.runs if (force2 or (force and r.state!="running") or r.state=="crashed")]
+    r_to_start.sort(key=lambda x: x.id)
     n_run = len(r_to_start)
 
     if n_run == 0:
@@ -274,20 +345,23 @@ def resume(sweep_id: str, multi_gpu: Optional[int], agents_per_gpu: Optional[int
     multi_gpu = multi_gpu or 1
     agents_per_gpu = agents_per_gpu or 1
 
-    assert agents_per_gpu == 1, "agents_per_gpu != 1 not supported for resume"
-
     check_runtime(runtime)
 
     wandb_env = config.get_wandb_env()
     assert wandb_env, "W&B API key is needed for staring a W&B swipe"
 
-    tdirs = get_slurm_target_dir(config.get("slurm", {}).keys())
+    enabled_slurm_hosts = [k for k in config.get("slurm", {}).keys() if k in config.get_all_hosts()]
+    tdirs = get_slurm_target_dir(enabled_slurm_hosts)
     ckpt_dir = config.get("wandb_ckpt_path", "wandb/*${id}*/files/checkpoint")
     resume = config.get("resume_command", "--restore ${ckpt}")
 
+    manifests = get_resume_manifests(enabled_slurm_hosts, [r.id for r in r_to_start])
+
     cmd_base = get_wandb_sweep_command_without_args(sweep_id)
 
     name = f"resume_{sweep.id}"
+    # Each submission has its own manifest, so the queued tasks of an earlier one still find theirs.
+    manifest_name = f"{name}_{time.strftime('%Y%m%d_%H%M%S')}_{random_string(6)}.manifest.json"
 
     def run_agent(host):
         target_dir = get_slurm_target_full_path([host])[host]
@@ -301,9 +375,21 @@ def resume(sweep_id: str, multi_gpu: Optional[int], agents_per_gpu: Optional[int
         bash = config.get_command(host, "bash")
         env = config.get_env(host)
 
-        cmd = f"resume_jobs.py {sweep_id} '{ckpt_dir}' '{cmd_base} {resume}' {int(force)} {int(force2)}"
+        runs = manifests[host]
+        if not runs:
+            return
 
-        cnt = f"1-{n_run}"
+        manifest = f"{odir}/{manifest_name}"
+        _, errcode = remote_run(host, f"mkdir -p {odir} && cat > {manifest}",
+                                input=json.dumps({"sweep": sweep_id, "runs": runs}))
+        if errcode != 0:
+            print(f"WARNING: failed to write the resume manifest on {host}")
+            return
+
+        cmd = f"resume_jobs.py {sweep_id} '{ckpt_dir}' '{cmd_base} {resume}' {int(force)} {int(force2)} {manifest}"
+
+        cmd = get_pack_command(cmd, agents_per_gpu, runtime, len(runs))
+        cnt = f"1-{int(math.ceil(len(runs) / get_runs_per_task(agents_per_gpu)))}"
 
         if multi_gpu > 1:
             bashcmd = f"if [[ $SLURM_PROCID -eq 0  && -z $SLURM_RESTART_COUNT ]]; then {cmd}; else pwd; {cmd_base}; fi"
@@ -316,9 +402,6 @@ def resume(sweep_id: str, multi_gpu: Optional[int], agents_per_gpu: Optional[int
 
         res = get_cpu_and_mem(host)
 
-        if agents_per_gpu != 1:
-            raise ValueError("agents_per_gpu != 1 not supported for stanford template")
-
         slurm_flags = get_slurm_flags(host, multi_gpu)
         
         account = f"--account={account}" if account else ""
@@ -332,14 +415,16 @@ def resume(sweep_id: str, multi_gpu: Optional[int], agents_per_gpu: Optional[int
         remote_run(host, cmd)
 
     install_helper()
-    enabled_slurm_hosts = [k for k in config.get("slurm", {}).keys() if k in config.get_all_hosts()]
     send_payload(enabled_slurm_hosts, "resume_jobs.py")
+    if get_runs_per_task(agents_per_gpu) > 1:
+        send_payload(enabled_slurm_hosts, "pack_runs.py")
     parallel_map(enabled_slurm_hosts, run_agent)
 
 
 def check_login(host: str):
     # Define the command to run
-    command = ['ssh', '-o', 'BatchMode=yes', host, 'exit']
+    command = ['ssh', '-o', 'BatchMode=yes', '-o', f"ConnectTimeout={config.get('ssh_connect_timeout', 30)}", host,
+               'exit']
 
     # Run the command and capture its output and exit status
     process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
@@ -347,6 +432,9 @@ def check_login(host: str):
 
 
 def update_cscs_ssh_keys(host: str):
+    import pyotp
+    import requests
+
     secret = config["slurm"][host]["cscs_auth"]
 
     otp = pyotp.TOTP(secret["otp_secret"]).now()
@@ -371,19 +459,95 @@ def update_cscs_ssh_keys(host: str):
         f.write(data["public"])
 
 
-def update_slurm_authentication():
+def get_cscs_key_expiry() -> Optional[float]:
+    # The expiry of the signed key, read locally from the certificate. None if it is not available.
+    for path in CSCS_CERT_FILES:
+        path = os.path.expanduser(path)
+        if not os.path.isfile(path):
+            continue
+
+        process = subprocess.run(["ssh-keygen", "-L", "-f", path], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if process.returncode != 0:
+            continue
+
+        for line in process.stdout.decode().split("\n"):
+            line = line.strip()
+            if line.startswith("Valid:"):
+                if "forever" in line:
+                    return float("inf")
+                if " to " in line:
+                    return datetime.datetime.strptime(line.split(" to ")[-1].strip(), "%Y-%m-%dT%H:%M:%S").timestamp()
+    return None
+
+
+def is_cscs_key_valid(host: str) -> bool:
+    # Uses the expiry of the certificate if possible. Otherwise, logs in to the host, and caches the result.
+    expiry = get_cscs_key_expiry()
+    if expiry is not None:
+        return expiry - time.time() > config.get("cscs_refresh_margin", 1800)
+
+    if auth_cache.get(host, config.get("cscs_auth_check_ttl", 3600)):
+        return True
+
+    valid = check_login(host)
+    if valid:
+        auth_cache.set(host, True)
+    return valid
+
+
+def refresh_cscs_ssh_keys(hosts: List[str]):
+    global keys_refreshed_at
+    print(f"The following hosts require updating CSCS authentication: {','.join(hosts)}")
+    for h in hosts:
+        update_cscs_ssh_keys(h)
+        auth_cache.invalidate(h)
+    keys_refreshed_at = time.time()
+
+
+def update_slurm_authentication(hosts: List[str]):
+    # Only for the hosts used by the current command
     if not config.get("slurm"):
         return
 
-    hosts_with_auth = [h for h in config.get("slurm", {}).keys() if "cscs_auth" in  config["slurm"][h]]
+    hosts_with_auth = [h for h in config.get("slurm", {}).keys() if "cscs_auth" in  config["slurm"][h] and h in hosts]
 
-    auth_state = parallel_map(hosts_with_auth, check_login)
+    auth_state = parallel_map(hosts_with_auth, is_cscs_key_valid)
     unauthenticated_hosts = [h for h, a in zip(hosts_with_auth, auth_state) if not a]
 
     if not unauthenticated_hosts:
         return
 
-    print(f"The following hosts require updating CSCS authentication: {','.join(unauthenticated_hosts)}")
-    for h in unauthenticated_hosts:
-        update_cscs_ssh_keys(h)
+    refresh_cscs_ssh_keys(unauthenticated_hosts)
+
+
+def handle_auth_failure(host: str) -> bool:
+    # Called when an ssh command fails on a host, which can also mean that the host is down. If it failed because of
+    # the expired CSCS key, refreshes it and returns True, so the command is retried.
+    if "cscs_auth" not in config.get("slurm", {}).get(host, {}):
+        return False
+
+    with auth_refresh_lock:
+        if keys_refreshed_at is not None:
+            # Only the commands started with the old key are retried. A new failure is not about the key.
+            return time.time() - keys_refreshed_at < 60
+
+        try:
+            if time.time() - os.path.getmtime(os.path.expanduser("~/.ssh/id_rsa_cscs")) < 60:
+                # Refreshed by another invocation in the meanwhile
+                return True
+        except OSError:
+            pass
+
+        expiry = get_cscs_key_expiry()
+        if expiry is not None:
+            if expiry - time.time() > config.get("cscs_refresh_margin", 1800):
+                return False
+        elif check_login(host):
+            # The failure was not about authentication.
+            return False
+
+        refresh_cscs_ssh_keys([host])
+        return True
+
 
+process_tools.auth_failure_handlers.append(handle_auth_failure)
@@ -0,0 +1,166 @@
+import os
+import time
+import shlex
+import signal
+import asyncio
+import subprocess
+from threading import Lock
+from typing import Dict, Optional, Iterable
+from .config import config
+from .utils import get_cache_dir, is_local
+
+
+class SSHConnectionPool:
+    # Keeps a single OpenSSH ControlMaster connection per host. Every later ssh (or rsync over ssh) call to the same
+    # host is multiplexed over it as a new channel, so only the first command pays for the TCP + auth handshake.
+    # The master outlives the invocation by ssh_control_persist seconds, so back-to-back ct commands reuse it too.
+    # Note: the number of channels per master is limited by MaxSessions on the server (10 by default), which is
+    # above HostCallLimiter.N_CONNECTIONS_PER_HOST.
+
+    def __init__(self):
+        self.mutex = Lock()
+        self.host_locks: Dict[str, Lock] = {}
+        self.masters: Dict[str, bool] = {}
+        self.n_handshakes = 0
+        self.n_reused = 0
+
+    def is_enabled(self) -> bool:
+        return config.get("ssh_multiplexing", True) and os.name != "nt"
+
+    def get_connect_timeout_flag(self) -> str:
+        return f" -o ConnectTimeout={config.get('ssh_connect_timeout', 30)} "
+
+    def get_mux_flags(self, host: str) -> str:
+        control_path = os.path.join(get_cache_dir("ssh"), "%C")
+        persist = config.get("ssh_control_persist", 300)
+        return f" -o ControlMaster=auto -o ControlPath={shlex.quote(control_path)} -o ControlPersist={persist} "
+
+    def get_host_lock(self, host: str) -> Lock:
+        with self.mutex:
+            if host not in self.host_locks:
+                self.host_locks[host] = Lock()
+            return self.host_locks[host]
+
+    def kill(self, pid: int):
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    def run_ssh(self, args: str, host: str, deadline: Optional[float] = None) -> Optional[int]:
+        # Returns None if it is not finished before the deadline (absolute time.time()).
+        timeout = None if deadline is None else deadline - time.time()
+        if timeout is not None and timeout <= 0:
+            return None
+
+        proc = subprocess.Popen(self.get_ssh_cmdline(args, host), shell=True, stdin=subprocess.DEVNULL,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+        try:
+            return proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.kill(proc.pid)
+            proc.wait()
+            return None
+
+    async def run_ssh_async(self, args: str, host: str, deadline: Optional[float] = None) -> Optional[int]:
+        timeout = None if deadline is None else deadline - time.time()
+        if timeout is not None and timeout <= 0:
+            return None
+
+        proc = await asyncio.create_subprocess_shell(self.get_ssh_cmdline(args, host), stdin=subprocess.DEVNULL,
+                                                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                                     start_new_session=True)
+        try:
+            return await asyncio.wait_for(proc.wait(), timeout)
+        except asyncio.TimeoutError:
+            self.kill(proc.pid)
+            await proc.wait()
+            return None
+
+    def get_ssh_cmdline(self, args: str, host: str) -> str:
+        from . import process_tools
+        cmd = "ssh " + config.get_ssh_flags(host) + self.get_connect_timeout_flag() + self.get_mux_flags(host) + \
+              args + " " + host
+        if process_tools.DEBUG:
+            print("RUN: ", cmd)
+        return cmd
+
+    def open_master(self, host: str, deadline: Optional[float] = None) -> bool:
+        # A master left running by a previous invocation can be reused without any handshake.
+        if self.run_ssh("-O check", host, deadline) == 0:
+            return True
+
+        self.n_handshakes += 1
+        return self.run_ssh("", host + " exit", deadline) == 0
+
+    async def open_master_async(self, host: str, deadline: Optional[float] = None) -> bool:
+        if await self.run_ssh_async("-O check", host, deadline) == 0:
+            return True
+
+        self.n_handshakes += 1
+        return await self.run_ssh_async("", host + " exit", deadline) == 0
+
+    async def open_masters_async(self, hosts: Iterable[str], slots: asyncio.Semaphore,
+                                 deadlines: Optional[Dict[str, Optional[float]]] = None):
+        # Opens the masters of all new hosts concurrently from the event loop, so that the later connect() calls
+        # don't block it. Opening the master of a host is abandoned at its deadline (absolute time.time()).
+        if not self.is_enabled():
+            return
+
+        deadlines = deadlines or {}
+
+        async def open_one(host):
+            async with slots:
+                return await self.open_master_async(host, deadlines.get(host))
+
+        new_hosts = [h for h in set(hosts) if h not in self.masters and not is_local(h)]
+        states = await asyncio.gather(*[open_one(h) for h in new_hosts])
+        for host, state in zip(new_hosts, states):
+            with self.get_host_lock(host):
+                self.masters.setdefault(host, state)
+
+            if not state:
+                self.print_fallback_warning(host)
+
+    def print_fallback_warning(self, host: str):
+        print(f"WARNING: failed to open a persistent SSH connection to {host}. Falling back to separate connections.")
+
+    def connect(self, host: str, deadline: Optional[float] = None) -> Optional[str]:
+        # Returns the extra flags that route an ssh call through the master of the host, or None if multiplexing
+        # is not available for it. Doesn't wait for the master beyond the deadline (absolute time.time()).
+        if not self.is_enabled():
+            return None
+
+        lock = self.get_host_lock(host)
+        if not lock.acquire(timeout=-1 if deadline is None else max(deadline - time.time(), 0)):
+            return None
+
+        try:
+            state = self.masters.get(host)
+            if state is None:
+                state = self.open_master(host, deadline)
+                self.masters[host] = state
+                if not state:
+                    self.print_fallback_warning(host)
+
+            if state:
+                self.n_reused += 1
+        finally:
+            lock.release()
+
+        return self.get_mux_flags(host) if state else None
+
+    def get_ssh_command(self, host: str, deadline: Optional[float] = None) -> str:
+        return "ssh " + config.get_ssh_flags(host) + self.get_connect_timeout_flag() + \
+               (self.connect(host, deadline) or "")
+
+    def get_rsync_flags(self, host: str) -> str:
+        # rsync -e flag using the same ssh configuration as remote_run.
+        return " -e " + shlex.quote(self.get_ssh_command(host).strip()) + " "
+
+    def get_report(self) -> str:
+        return f"SSH connection pool: {len(self.masters)} hosts, {self.n_handshakes} handshakes, " \
+               f"{max(self.n_reused - self.n_handshakes, 0)} handshakes saved by reusing connections."
+
+
+connection_pool = SSHConnectionPool()
@@ -1,34 +1,132 @@
 import os
+import json
 import shlex
+import posixpath
+import hashlib
+import shutil
+import tempfile
+import time
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
 from .process_tools import run_process, run_multiple_hosts
 from .parallel_map import parallel_map_dict, parallel_map
 from .config import config
 from .slurm import get_slurm_target_full_path
-from .process_tools import remote_run
+from .process_tools import remote_run, get_remote_command
+from .ssh_pool import connection_pool
+from .cache import JSONCache
+from .utils import get_cache_dir, random_string, quote_remote_path
+from . import remote_agent
+from .remote_agent import RemoteAgentError
 
+# The digest of the manifest last pushed to each (host, destination, source). Hosts already having the current
+# manifest are skipped, the others get only the files changed since their last manifest.
+sync_state = JSONCache("sync_state")
 
-def sync(src, host, remote_prefix, exclude=['.git*', '.gitignore'], ignore_files=[]):
-    remote_prefix = remote_prefix.strip()
+# The ID of the filesystem of the destination directories, for finding the hosts sharing it.
+shared_fs_cache = JSONCache("shared_fs")
+
+# The files downloaded by gather from each (host, remote path): {relative path: [size, mtime in ms, local path]}
+gather_state = JSONCache("gather_state")
+FSID_MARKER = ".cluster_tool_fsid"
+
+local_manifests: Dict[Tuple[str, str], Tuple[str, Dict[str, Optional[List[int]]]]] = {}
+manifest_lock = Lock()
 
-    args = ""
+
+def get_filter_args(exclude, ignore_files) -> str:
+    # The marker of the shared filesystem detection is never synced or deleted.
+    args = f" --exclude={FSID_MARKER}"
     for e in exclude:
         args += f" --exclude={shlex.quote(e)}"
 
     for i in ignore_files:
         args += f" --filter=':- {i}'"
+    return args
 
-    if remote_prefix:
-        in_home = remote_prefix.startswith("~/")
-        if in_home:
-            remote_prefix = remote_prefix[2:]
-        remote_prefix = shlex.quote(remote_prefix)
-        if in_home:
-            remote_prefix = "~/"+remote_prefix
 
-    host = config.get_data_transfer_node(host)
-    remote_run(host, "mkdir -p "+remote_prefix)
+def get_source_base(src: str) -> str:
+    # The directory the names in the manifest are relative to (rsync copies the directory itself, unless src ends
+    # with /)
+    return src if src.endswith("/") else (os.path.dirname(os.path.normpath(src)) or ".")
+
+
+def list_local_files(src: str, filter_args: str) -> Optional[List[str]]:
+    # Lets rsync itself decide what to transfer, so the manifest uses exactly the same filters as the real sync.
+    # Directories end with /.
+    with tempfile.TemporaryDirectory() as empty_dir:
+        stdout, err = run_process("rsync -rn --out-format=%n" + filter_args + " " + shlex.quote(src) + " " +
+                                  shlex.quote(empty_dir))
+    if err != 0:
+        return None
+
+    base = get_source_base(src)
+    return [l for l in stdout.split("\n") if l and os.path.lexists(os.path.join(base, l))]
+
+
+def get_manifest(src: str, filter_args: str) -> Tuple[Optional[str], Dict[str, Optional[List[int]]]]:
+    # Size and modification time of all files to be synced, and the digest of it. Computed once per invocation.
+    key = (os.path.abspath(src), filter_args)
+    with manifest_lock:
+        if key not in local_manifests:
+            files = list_local_files(src, filter_args)
+            if files is None:
+                return None, {}
+
+            base = get_source_base(src)
+            manifest = {}
+            for f in files:
+                if f.endswith("/"):
+                    manifest[f] = None
+                else:
+                    st = os.stat(os.path.join(base, f))
+                    manifest[f] = [st.st_size, st.st_mtime_ns]
+
+            data = json.dumps(manifest, sort_keys=True)
+            digest = hashlib.sha1(data.encode()).hexdigest()
+
+            path = os.path.join(get_cache_dir("sync_manifests"), digest + ".json")
+            if not os.path.exists(path):
+                with open(path, "w") as f:
+                    f.write(data)
+
+            local_manifests[key] = digest, manifest
+        return local_manifests[key]
+
 
-    cmd = "rsync -r --delete "+shlex.quote(src)+args+" "+host+":"+remote_prefix
+def clear_manifests():
+    # The manifests are computed once per invocation. Long running invocations (--watch) clear them before each sync.
+    with manifest_lock:
+        local_manifests.clear()
+
+
+def collect_manifests():
+    # Deletes the manifests no longer referenced by a valid state, except the ones of this invocation.
+    ttl = get_state_ttl()
+    keep = {e["value"] for e in sync_state.read_file().values() if time.time() - e["time"] <= ttl}
+    with manifest_lock:
+        keep.update(d for d, _ in local_manifests.values())
+
+    dir = get_cache_dir("sync_manifests")
+    for name in os.listdir(dir):
+        if name.endswith(".json") and name[:-5] not in keep:
+            try:
+                os.remove(os.path.join(dir, name))
+            except OSError:
+                pass
+
+
+def load_manifest(digest: str) -> Optional[Dict[str, Optional[List[int]]]]:
+    try:
+        with open(os.path.join(get_cache_dir("sync_manifests"), digest + ".json")) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def push_full(src, host, remote_prefix, filter_args) -> bool:
+    cmd = "rsync -rt --delete"+connection_pool.get_rsync_flags(host)+shlex.quote(src)+filter_args+" "+host+":"+\
+          remote_prefix
     stdout, err = run_process(cmd)
 
     if err!=0:
@@ -39,41 +137,491 @@ def sync(src, host, remote_prefix, exclude=['.git*', '.gitignore'], ignore_files
     return True
 
 
-def gather_files_from_host(host, files, dirs, postfix, dest_folder, remote_path):
-    host_prefix = host.split(".")[0]
+def use_tar_transport(sizes: List[int]) -> bool:
+    # Many small files are faster to send as a single compressed stream than one by one with rsync.
+    cfg = config.get("sync", {})
+    transport = cfg.get("transport", "auto")
+    if transport != "auto":
+        return transport == "tar"
 
-    os.makedirs(dest_folder, exist_ok=True)
-    for f in files:
-        local_fname = f + ("_" + host_prefix if f in postfix else "")
-        dest_file = os.path.join(dest_folder, local_fname)
+    return len(sizes) >= cfg.get("tar_min_files", 500) and \
+        sum(sizes) <= len(sizes) * cfg.get("tar_max_avg_size", 256 * 1024)
+
+
+def push_tar(base, host, remote_prefix, files: List[str]) -> bool:
+    # Streams the listed files (without recursion) as a compressed archive through a single ssh session. The bsdtar
+    # of macOS would add AppleDouble (._*) entries for the extended attributes without COPYFILE_DISABLE.
+    remote_prefix = remote_prefix or "~"
+    unpack = get_remote_command(host, f"mkdir -p {remote_prefix} && tar xzf - -C {remote_prefix}", alternative=False)
+    cmd = f"COPYFILE_DISABLE=1 tar czf - --null --no-recursion -C {shlex.quote(base)} -T - | {unpack}"
+    stdout, err = run_process(cmd, input="\0".join(files))
+
+    if err != 0:
+        print(stdout)
+        print("ERROR: failed to run %s" % cmd)
+        return False
 
-        path_postfix="/" if f in dirs else ""
+    return True
 
-        host = config.get_data_transfer_node(host)
-        cmd = "rsync -r " + host + ":" + shlex.quote(remote_path + "/" + f) + path_postfix + " '" + dest_file + "'"
 
-        stdout, err = run_process(cmd)
+def push_files(base, host, remote_prefix, files: List[str]) -> bool:
+    # Without -r, only the listed files are sent, and the listed directories are created.
+    cmd = "rsync -t --files-from=-" + connection_pool.get_rsync_flags(host) + shlex.quote(base) + " " + host + ":" + \
+          remote_prefix
+    stdout, err = run_process(cmd, input="\n".join(files))
+    if err != 0:
+        print(stdout)
+        print("ERROR: failed to run %s" % cmd)
+        return False
+
+    return True
+
+
+def get_state_key(src, host, remote_prefix) -> str:
+    return f"{host}:{remote_prefix}:{os.path.abspath(src)}"
+
+
+def get_state_ttl() -> float:
+    # The state is trusted only for a limited time, in case the files were changed on the host in the meantime.
+    # After that the root is synced fully again.
+    return config.get("sync", {}).get("state_ttl", 24 * 3600)
+
+
+def is_up_to_date(src, host, remote_prefix, exclude, ignore_files) -> bool:
+    digest, _ = get_manifest(src, get_filter_args(exclude, ignore_files))
+    host = config.get_data_transfer_node(host)
+    return digest is not None and \
+        sync_state.get(get_state_key(src, host, quote_remote_path(remote_prefix.strip())), get_state_ttl()) == digest
+
+
+def get_deletable(src, paths: List[str], filter_args, ignore_files) -> List[str]:
+    # The paths removed from the manifest which are really gone and would still be synced with the current filters.
+    # Files excluded since the last sync (e.g. newly added to .gitignore) are kept on the host, like rsync --delete
+    # does. The filters are checked by rsync on empty placeholders, next to copies of the local ignore files.
+    base = get_source_base(src)
+    gone = [p for p in paths if not os.path.lexists(os.path.join(base, p))]
+    if not gone:
+        return []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            dirs = set()
+            for p in gone:
+                path = os.path.join(tmp, p)
+                if p.endswith("/"):
+                    os.makedirs(path, exist_ok=True)
+                else:
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    open(path, "w").close()
+
+                parts = p.rstrip("/").split("/")[:-1]
+                dirs.update("/".join(parts[:i]) for i in range(len(parts) + 1))
+
+            for d in dirs:
+                for name in ignore_files:
+                    if os.path.isfile(os.path.join(base, d, name)):
+                        shutil.copyfile(os.path.join(base, d, name), os.path.join(tmp, d, name))
+        except OSError:
+            return []
+
+        listed = list_local_files(tmp + "/" if src.endswith("/") else os.path.join(tmp, os.path.basename(
+                                  os.path.normpath(src))), filter_args)
+
+    listed = set(listed or [])
+    return [p for p in gone if p in listed]
+
+
+def plan_sync(src, host, remote_prefix, filter_args, ignore_files) -> Optional[Dict]:
+    # What to do with a single sync root. None if it is up to date.
+    raw_prefix = remote_prefix.strip()
+    remote_prefix = quote_remote_path(raw_prefix)
+    digest, manifest = get_manifest(src, filter_args)
+
+    last_digest = sync_state.get(get_state_key(src, host, remote_prefix), get_state_ttl()) \
+        if digest is not None else None
+    if digest is not None and last_digest == digest:
+        return None
+
+    old_manifest = load_manifest(last_digest) if last_digest is not None else None
+    plan = {"src": src, "remote_prefix": remote_prefix, "raw_prefix": raw_prefix or "~", "digest": digest,
+            "full": old_manifest is None, "deleted": [], "send": []}
+
+    if old_manifest is None:
+        # Bulk upload, followed by rsync to delete the stale files. The rsync skips everything already sent, because
+        # tar preserves the modification times.
+        if digest is not None and use_tar_transport([v[0] for v in manifest.values() if v is not None]):
+            plan["send"] = list(manifest.keys())
+    else:
+        plan["deleted"] = get_deletable(src, [f for f in old_manifest if f not in manifest], filter_args,
+                                        ignore_files)
+        plan["send"] = [f for f, v in manifest.items() if f not in old_manifest or old_manifest[f] != v]
+
+    plan["sizes"] = [manifest[f][0] for f in plan["send"] if manifest[f] is not None]
+    return plan
+
+
+def merge_transfers(plans: List[Dict]) -> List[Dict]:
+    # Merges the files to send from different roots into a single transfer, if they map to the same remote location
+    # relative to a common local base directory. For example ~/project -> ~/project and ~/data -> ~/data.
+    transfers = []
+    for plan in plans:
+        if not plan["send"]:
+            continue
+
+        base = os.path.abspath(get_source_base(plan["src"]))
+        for t in transfers:
+            rel = os.path.relpath(base, t["base"])
+            if not rel.startswith("..") and \
+                    posixpath.normpath(posixpath.join(t["raw_prefix"], rel)) == posixpath.normpath(plan["raw_prefix"]):
+                rel = "" if rel == "." else rel + "/"
+                break
+        else:
+            t = {"base": base, "raw_prefix": plan["raw_prefix"], "remote_prefix": plan["remote_prefix"], "files": [],
+                 "sizes": [], "plans": []}
+            transfers.append(t)
+            rel = ""
+
+        # Paths given explicitly in sync.extra can be part of the project as well.
+        known = set(t["files"])
+        t["files"] += [rel + f for f in plan["send"] if rel + f not in known]
+        t["sizes"] += plan["sizes"]
+        t["plans"].append(plan)
+
+    return transfers
+
+
+def get_prepare_script(plans: List[Dict]) -> str:
+    # Creates all the destination directories and deletes the removed files, in a single round-trip. Only the listed
+    # files are deleted, and the listed directories only if they are empty, so the files created on the host stay.
+    lines = ["mkdir -p " + " ".join(p["remote_prefix"] or "~" for p in plans)]
+    for p in plans:
+        files = [shlex.quote(f) for f in p["deleted"] if not f.endswith("/")]
+        dirs = [shlex.quote(f) for f in sorted(p["deleted"], key=len, reverse=True) if f.endswith("/")]
+        if files or dirs:
+            lines.append(f"(cd {p['remote_prefix'] or '~'} && {{ " +
+                         (f"rm -f -- {' '.join(files)}; " if files else "") +
+                         (f"rmdir -- {' '.join(dirs)} 2>/dev/null; " if dirs else "") + "true; })")
+    return " && \\\n".join(lines) + "\n"
+
+
+def sync_many(host, roots: List[Tuple[str, str]], exclude=['.git*', '.gitignore'], ignore_files=[]) -> bool:
+    # Syncs several local paths to their remote directories. The directories are prepared by a single remote
+    # command, and the changed files of all roots are sent together where possible. Roots never synced before
+    # need an additional rsync --delete each.
+    filter_args = get_filter_args(exclude, ignore_files)
+    host = config.get_data_transfer_node(host)
+
+    plans = [p for p in (plan_sync(src, host, dest, filter_args, ignore_files) for src, dest in roots)
+             if p is not None]
+    if not plans:
+        return True
+
+    # The directories of incremental updates exist already, so small changes need no extra round-trip.
+    if any(p["full"] or p["deleted"] for p in plans):
+        stdout, err = remote_run(host, "bash -s", alternative=False, input=get_prepare_script(plans))
         if err != 0:
             print(stdout)
-            print("ERROR: failed to run %s" % cmd)
+            print(f"ERROR: failed to prepare the target directories on {host}")
+            return False
+
+    failed = set()
+    for t in merge_transfers(plans):
+        send = push_tar if use_tar_transport(t["sizes"]) else push_files
+        if not send(t["base"], host, t["remote_prefix"], t["files"]):
+            failed.update(id(p) for p in t["plans"] if not p["full"])
+
+    for p in plans:
+        if p["full"] and not push_full(p["src"], host, p["remote_prefix"], filter_args):
+            failed.add(id(p))
+
+    for p in plans:
+        if id(p) not in failed and p["digest"] is not None:
+            sync_state.set(get_state_key(p["src"], host, p["remote_prefix"]), p["digest"])
+
+    return not failed
 
 
-def run_remote_list(hosts, cmd):
-    paths = run_multiple_hosts(hosts, cmd)
-    return {k: [a.strip() for a in v[0].split() if a] for k, v in paths.items() if v[1] == 0}
+def sync(src, host, remote_prefix, exclude=['.git*', '.gitignore'], ignore_files=[]):
+    return sync_many(host, [(src, remote_prefix)], exclude, ignore_files)
+
+
+def move_merge(src, dest):
+    # Moves src to dest, merging the directories if dest already exists.
+    if os.path.isdir(src) and os.path.isdir(dest):
+        for f in os.listdir(src):
+            move_merge(os.path.join(src, f), os.path.join(dest, f))
+        os.rmdir(src)
+    else:
+        if os.path.isdir(dest):
+            shutil.rmtree(dest)
+        os.replace(src, dest)
 
 
-def gather(dest_folder, hosts, remote_path, mode="on_conflict_confirm"):
-    res = run_remote_list(hosts, "ls "+shlex.quote(remote_path)+" 2>/dev/null")
-    dirs = run_remote_list(hosts, "ls -d " + shlex.quote(remote_path)+"/*/ 2>/dev/null")
+def pull_files(host, files, dest_folder, remote_path) -> bool:
+    # A single compressed rsync for all the listed files. The listed directories are only created.
+    cmd = "rsync -tz --files-from=-" + connection_pool.get_rsync_flags(host) + host + ":" + \
+          quote_remote_path(remote_path.rstrip("/") + "/") + " " + shlex.quote(dest_folder)
+    stdout, err = run_process(cmd, input="\n".join(files))
+    if err != 0:
+        print(stdout)
+        print("ERROR: failed to run %s" % cmd)
+        return False
+    return True
 
-    dirs = {k: [os.path.split(os.path.normpath(a))[-1] for a in v if a] for k, v in dirs.items()}
+
+def prune_local_files(dest_folder, paths: List[str]):
+    # Deletes the local copies of the files removed from the hosts, and the directories left empty.
+    for p in paths:
+        p = os.path.join(dest_folder, p)
+        if os.path.isfile(p) or os.path.islink(p):
+            os.remove(p)
+
+    for p in sorted(paths, key=len, reverse=True):
+        p = os.path.join(dest_folder, p)
+        if os.path.isdir(p) and not os.listdir(p):
+            os.rmdir(p)
+
+
+def gather_files_from_host(host, tree, postfix, dest_folder, remote_path, exclude=()) -> Tuple[int, int]:
+    # Downloads the files not downloaded before, or changed since. The entries to be postfixed with the host name
+    # are downloaded to a staging directory and renamed after. The paths in exclude are provided by other hosts.
+    # Returns the number and the total size of the unchanged files skipped.
+    host_prefix = host.split(".")[0]
+    state_key = f"{host}:{remote_path}"
+    host = config.get_data_transfer_node(host)
+    old_state = gather_state.get(state_key) or {}
+
+    def get_local_path(path):
+        top, sep, rest = path.partition("/")
+        return top + ("_" + host_prefix if top in postfix else "") + sep + rest
+
+    state = {}
+    direct = []
+    renamed = []
+    n_skipped = 0
+    saved = 0
+    for path, (size, mtime, is_dir) in tree.items():
+        local_path = get_local_path(path)
+        state[path] = [size, mtime, local_path]
+        if path in exclude:
+            continue
+
+        if old_state.get(path) == state[path] and os.path.lexists(os.path.join(dest_folder, local_path)):
+            if not is_dir:
+                n_skipped += 1
+                saved += size
+            continue
+
+        (renamed if path.split("/")[0] in postfix else direct).append(path)
+
+    os.makedirs(dest_folder, exist_ok=True)
+    ok = True
+    if direct:
+        ok = pull_files(host, direct, dest_folder, remote_path)
+
+    if renamed:
+        staging = tempfile.mkdtemp(prefix=".ct_gather_", dir=dest_folder)
+        try:
+            if pull_files(host, renamed, staging, remote_path):
+                for f in os.listdir(staging):
+                    move_merge(os.path.join(staging, f), os.path.join(dest_folder, f + "_" + host_prefix))
+            else:
+                ok = False
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    if ok:
+        gather_state.set(state_key, state)
+
+    return n_skipped, saved
+
+
+def parse_tree(text: str) -> Dict[str, List]:
+    res = {}
+    for line in text.split("\n"):
+        fields = line.split("\t")
+        if len(fields) != 4 or fields[0].split("/")[0].startswith("."):
+            continue
+        res[fields[0]] = [int(fields[1]), int(float(fields[2]) * 1000), fields[3] == "d"]
+    return res
+
+
+def list_remote_trees(hosts, remote_path) -> Dict[str, Dict[str, List]]:
+    # All entries under remote_path on the hosts where it exists and is not empty, in a single round-trip per host:
+    # {relative path: [size, mtime in ms, is directory]}. Uses the helper agent if possible.
+    def list_with_agent(host):
+        try:
+            entries = remote_agent.call(host, "walk", path=remote_path)
+        except RemoteAgentError:
+            return None
+
+        # None if the directory doesn't exist on this host
+        return {e[0]: e[1:] for e in entries or []}
+
+    res = {k: v for k, v in parallel_map_dict(hosts, list_with_agent).items() if v is not None}
+
+    rest = [h for h in hosts if h not in res]
+    if rest:
+        listed = run_multiple_hosts(rest, f"cd {quote_remote_path(remote_path)} 2>/dev/null && "
+                                          f"find . -mindepth 1 -printf '%P\\t%s\\t%T@\\t%y\\n'")
+        res.update({k: parse_tree(v[0]) for k, v in listed.items() if v[1] == 0})
+
+    return {k: v for k, v in res.items() if v}
+
+
+def hash_remote_entries(trees, entries: Dict[str, List[str]], remote_path) -> Dict[str, Dict[str, str]]:
+    # SHA1 of all files in the given top-level entries of remote_path, for each host: {relative path: hash}. The
+    # hashes are kept in the gather state by size and modification time, so only the new and changed files are hashed.
+    def hash_host(host):
+        key = f"{host}:{remote_path}:hashes"
+        known = gather_state.get(key) or {}
+        tops = set(entries[host])
+        files = {p: v[:2] for p, v in trees[host].items() if not v[2] and p.split("/")[0] in tops}
+
+        res = {p: known[p][2] for p, v in files.items() if p in known and known[p][:2] == v}
+        missing = [p for p in files if p not in res]
+        if missing:
+            res.update(hash_files(host, missing, remote_path))
+            gather_state.set(key, {p: v + [res[p]] for p, v in files.items() if p in res})
+        return res
+
+    return parallel_map_dict(list(entries.keys()), hash_host)
+
+
+def hash_files(host, files: List[str], remote_path) -> Dict[str, str]:
+    try:
+        return remote_agent.call(host, "hash", path=remote_path, entries=files)
+    except RemoteAgentError:
+        pass
+
+    # The list is passed on stdin, because it can be too long for the command line.
+    stdout, err = remote_run(config.get_data_transfer_node(host),
+                             f"cd {quote_remote_path(remote_path)} && xargs -d '\\n' sha1sum --", alternative=False,
+                             input="\n".join(files))
+
+    # Lines starting with \ are for names with special characters, which are ignored. Files that failed to hash are
+    # missing.
+    return {l[42:]: l[:40] for l in stdout.split("\n") if len(l) > 42 and not l.startswith("\\")}
+
+
+def find_duplicates(trees, entries: Dict[str, List[str]], remote_path) -> \
+        Tuple[Dict[str, List[List[str]]], Dict[str, Dict[str, str]]]:
+    # Groups the hosts by the content of each entry found on multiple hosts: {entry: [[hosts with identical
+    # content], ...]}. Also returns the file hashes.
+    hashes = hash_remote_entries(trees, entries, remote_path)
+
+    def get_signature(host, entry):
+        files = sorted((p, v[2]) for p, v in trees[host].items() if p.split("/")[0] == entry)
+        if any(not is_dir and p not in hashes[host] for p, is_dir in files):
+            # Failed to hash, assume it is unique.
+            return host
+        return tuple((p, hashes[host].get(p)) for p, _ in files)
+
+    all_hosts = {}
+    for host, host_entries in entries.items():
+        for e in host_entries:
+            all_hosts.setdefault(e, []).append(host)
+
+    groups = {}
+    for e, hosts in all_hosts.items():
+        by_content = {}
+        for h in hosts:
+            by_content.setdefault(get_signature(h, e), []).append(h)
+        groups[e] = list(by_content.values())
+
+    return groups, hashes
+
+
+def dedup_postfixed(trees, postfix, hashes, exclude, links):
+    # Files with identical content in the postfixed entries are downloaded only once and hardlinked to the other
+    # locations.
+    first = {}
+    for host, tree in trees.items():
+        host_postfix = set(postfix.get(host, []))
+        for path in sorted(tree.keys()):
+            top, sep, rest = path.partition("/")
+            h = hashes.get(host, {}).get(path)
+            if top not in host_postfix or h is None or path in exclude[host]:
+                continue
+
+            local_path = top + "_" + host.split(".")[0] + sep + rest
+            if h in first:
+                exclude[host].add(path)
+                links.append((first[h], local_path))
+            else:
+                first[h] = local_path
+
+
+def create_links(dest_folder, links):
+    for src, dest in links:
+        src = os.path.join(dest_folder, src)
+        dest = os.path.join(dest_folder, dest)
+        if not os.path.isfile(src):
+            continue
+
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if os.path.lexists(dest):
+            if os.path.samefile(src, dest):
+                continue
+            os.remove(dest)
+
+        try:
+            os.link(src, dest)
+        except OSError:
+            shutil.copy2(src, dest)
+
+
+def get_gathered_paths(hosts, remote_path) -> Dict[str, set]:
+    # The local paths of the files downloaded from each host in its last successful gather.
+    return {h: {v[2] for v in (gather_state.peek(f"{h}:{remote_path}")[0] or {}).values()} for h in hosts}
+
+
+def prune_gathered(dest_folder, old_paths: Dict[str, set], new_paths: Dict[str, set]):
+    # Runs once all hosts have finished. A local path is deleted only if no host has it anymore: not the ones
+    # still having it (maybe downloaded from another host because of the dedup), and not the ones failed to list
+    # or download (their state is unchanged).
+    keep = set().union(*new_paths.values())
+    prune_local_files(dest_folder, sorted(set().union(*old_paths.values()) - keep))
+
+
+def gather(dest_folder, hosts, remote_path, mode="on_conflict_confirm", prune=False):
+    old_paths = get_gathered_paths(hosts, remote_path) if prune else {}
+    trees = list_remote_trees(hosts, remote_path)
+    res = {h: sorted({p.split("/")[0] for p in tree}) for h, tree in trees.items()}
     postfix = {}
 
+    def report(skipped):
+        n_files = sum(s[0] for s in skipped)
+        if n_files:
+            print(f"Skipped {n_files} unchanged files ({sum(s[1] for s in skipped) / 2**20:.1f} MB)")
+
     def sync_sequential():
-        for host, files in res.items():
+        skipped = []
+        for host in res.keys():
             print("Syncing %s" % host)
-            gather_files_from_host(host, files, dirs.get(host, []), [], dest_folder, remote_path)
+            skipped.append(gather_files_from_host(host, trees[host], [], dest_folder, remote_path))
+        report(skipped)
+
+    def finish():
+        if prune:
+            prune_gathered(dest_folder, old_paths, get_gathered_paths(list(old_paths.keys()), remote_path))
+        return True
+
+    # Entries present on multiple hosts are compared by content. Identical ones are downloaded only once.
+    exclude = {h: set() for h in res.keys()}
+    links = []
+    duplicates = {}
+    hashes = {}
+    if mode != "sequential" and config.get("gather", {}).get("dedup", True):
+        counts = {}
+        for files in res.values():
+            for f in files:
+                counts[f] = counts.get(f, 0) + 1
+
+        candidates = {h: [f for f in files if counts[f] > 1] for h, files in res.items()}
+        candidates = {h: files for h, files in candidates.items() if files}
+        if candidates:
+            duplicates, hashes = find_duplicates(trees, candidates, remote_path)
 
     if mode in ["direct", "on_conflict", "on_conflict_confirm"]:
         error = False
@@ -83,7 +631,11 @@ def gather(dest_folder, hosts, remote_path, mode="on_conflict_confirm"):
                 all_files[f] = all_files.get(f, []) + [host]
 
         for file, hosts in all_files.items():
-            if len(hosts) != 1:
+            if len(hosts) != 1 and len(duplicates.get(file, [])) == 1:
+                # The same content everywhere
+                for h in hosts[1:]:
+                    exclude[h].update(p for p in trees[h] if p.split("/")[0] == file)
+            elif len(hosts) != 1:
                 error = True
                 if mode == "direct":
                     msg = "ERROR"
@@ -101,27 +653,32 @@ def gather(dest_folder, hosts, remote_path, mode="on_conflict_confirm"):
 
                 if inp.lower() in ["s", ""]:
                     sync_sequential()
-                    return True
+                    return finish()
                 elif inp.lower() not in ["a"]:
                     return False
             elif mode=="direct":
                 return False
     elif mode == "sequential":
         sync_sequential()
+        return finish()
     elif mode == "postfix":
         postfix = res
     else:
         assert False, "Invalid mode: %s" % mode
 
-    parallel_map(res.keys(), lambda t: gather_files_from_host(t, res[t], dirs.get(t,[]), postfix.get(t, []),
-                                                              dest_folder, remote_path))
-    return True
+    dedup_postfixed(trees, postfix, hashes, exclude, links)
+    report(parallel_map(res.keys(), lambda t: gather_files_from_host(t, trees[t], postfix.get(t, []), dest_folder,
+                                                                     remote_path, exclude[t]),
+                        max_workers=config.get("gather", {}).get("max_parallel", 8)))
+    create_links(dest_folder, links)
+    return finish()
 
-def gather_relative(folder, hosts, mode="on_conflict_confirm"):
+def gather_relative(folder, hosts, mode="on_conflict_confirm", prune=False):
     curr_dir = os.path.relpath(os.path.abspath(folder), os.path.expanduser("~"))
-    return gather(folder, hosts, "~/"+curr_dir, mode)
+    return gather(folder, hosts, "~/"+curr_dir, mode, prune)
 
-def sync_current_dir(host, remote_prefix=None, remote_base_dir=None):
+def get_sync_list(remote_prefix=None, remote_base_dir=None) -> List[Tuple[str, str]]:
+    # The local paths to sync and their remote destination directories
     cwd = os.getcwd()
     copy_this = "../"+os.path.split(cwd)[-1]
 
@@ -130,9 +687,6 @@ def sync_current_dir(host, remote_prefix=None, remote_base_dir=None):
         if remote_prefix==".":
             remote_prefix = ""
 
-    exclude = config.get("sync", {}).get("exclude", [".git*"])
-    blacklists = [".gitignore"] if config.get("sync", {}).get("use_gitignore", True) else []
-
     sync_list = [(copy_this, remote_prefix)]
     for e in config.get("sync", {}).get("extra", []):
         if e.startswith("~"):
@@ -140,21 +694,96 @@ def sync_current_dir(host, remote_prefix=None, remote_base_dir=None):
             dest_path = e
         else:
             src_path = os.path.join(copy_this, e)
-            dest_path = os.path.join(remote_prefix, src_path)
+            dest_path = os.path.join(remote_prefix, os.path.split(cwd)[-1], e)
 
         if os.path.exists(src_path):
             sync_list.append((src_path, dest_path+"/.."))
         else:
             print(f"WARNING: extra sync path {e} doesn't exists")
 
-    for p in sync_list:
-        prefix = remote_base_dir or "~/"
-        if not sync(p[0], host, os.path.join(prefix, p[1]), exclude, blacklists):
-            print(f"Failed to copy {p[0]} to {host}:{p[1]}. Stopping synchronization...")
+    prefix = remote_base_dir or "~/"
+    return [(p[0], os.path.join(prefix, p[1])) for p in sync_list]
+
+
+def get_sync_filters() -> Tuple[List[str], List[str]]:
+    exclude = config.get("sync", {}).get("exclude", [".git*"])
+    blacklists = [".gitignore"] if config.get("sync", {}).get("use_gitignore", True) else []
+    return exclude, blacklists
+
+
+def sync_current_dir(host, remote_prefix=None, remote_base_dir=None):
+    exclude, blacklists = get_sync_filters()
+    return sync_many(host, get_sync_list(remote_prefix, remote_base_dir), exclude, blacklists)
+
+
+def sync_from_peer(src, source, peer, remote_prefix, exclude, ignore_files) -> bool:
+    # Copies the files of the manifest from the source host to the peer directly, over the network of the cluster.
+    # Only the files changed since the last sync of the peer are copied, and only the files removed from the
+    # manifest are deleted, so the files created on the hosts are left alone. The source must be able to log in to
+    # the peer without a password.
+    filter_args = get_filter_args(exclude, ignore_files)
+    source = config.get_data_transfer_node(source)
+    peer = config.get_data_transfer_node(peer)
+
+    plan = plan_sync(src, peer, remote_prefix, filter_args, ignore_files)
+    if plan is None:
+        return True
+    if plan["digest"] is None:
+        return False
+
+    stdout, err = remote_run(peer, "bash -s", alternative=False, input=get_prepare_script([plan]))
+    if err != 0:
+        print(stdout)
+        print(f"WARNING: failed to prepare the target directory of {src} on {peer}. Copying it directly.")
+        return False
+
+    _, manifest = get_manifest(src, filter_args)
+    files = list(manifest.keys()) if plan["full"] else plan["send"]
+    if files:
+        ssh = f"ssh -o BatchMode=yes -o ConnectTimeout={config.get('ssh_connect_timeout', 30)}"
+        base = plan["remote_prefix"] or "~"
+        stdout, err = remote_run(source, f"rsync -t --files-from=- -e '{ssh}' {base}/ {peer}:{base}/",
+                                 alternative=False, input="\n".join(files))
+        if err != 0:
+            print(stdout)
+            print(f"WARNING: failed to copy {src} from {source} to {peer}. Copying it directly.")
             return False
 
+    sync_state.set(get_state_key(src, peer, plan["remote_prefix"]), plan["digest"])
     return True
 
+
+def fanout_sync(src, hosts: List[str], remote_prefix, n_seeds: int) -> Dict[str, bool]:
+    # Uploads to n_seeds hosts only. Every host having the files then copies them to one more host, doubling the
+    # number of sources in each round. Falls back to a direct upload if copying from a peer fails.
+    exclude, blacklists = get_sync_filters()
+    pending = [h for h in hosts if not is_up_to_date(src, h, remote_prefix, exclude, blacklists)]
+    res = {h: True for h in hosts if h not in pending}
+
+    seed_res = parallel_map_dict(pending[:n_seeds], lambda h: sync(src, h, remote_prefix, exclude, blacklists))
+    res.update(seed_res)
+    sources = [h for h, ok in seed_res.items() if ok]
+    pending = pending[n_seeds:]
+
+    while pending:
+        if not sources:
+            res.update(parallel_map_dict(pending, lambda h: sync(src, h, remote_prefix, exclude, blacklists)))
+            break
+
+        pairs = dict(zip(pending, sources))
+        pending = pending[len(pairs):]
+
+        def copy(peer):
+            return sync_from_peer(src, pairs[peer], peer, remote_prefix, exclude, blacklists) or \
+                   sync(src, peer, remote_prefix, exclude, blacklists)
+
+        round_res = parallel_map_dict(list(pairs.keys()), copy)
+        res.update(round_res)
+        sources += [h for h, ok in round_res.items() if ok]
+
+    return res
+
+
 def is_sync_needed(host):
     if not config.is_local_run(host):
         return True
@@ -175,10 +804,122 @@ def filter_hosts_to_sync(hosts):
     return [h for h in hosts if is_sync_needed(h)]
 
 
+def get_filesystem_id(host, remote_prefix) -> Optional[str]:
+    # Identifies the filesystem of the destination directory by a marker file with a random ID in it. The first
+    # host creating it wins (noclobber), all hosts sharing the filesystem read back the same ID.
+    ttl = config.get("sync", {}).get("shared_fs_ttl", 24 * 3600)
+    key = f"{host}:{remote_prefix}"
+    fsid = shared_fs_cache.get(key, ttl)
+    if fsid is not None:
+        return fsid
+
+    remote_prefix = quote_remote_path(remote_prefix.strip()) or "~"
+    stdout, err = remote_run(config.get_data_transfer_node(host),
+                             f"mkdir -p {remote_prefix} && cd {remote_prefix} && "
+                             f"(set -C; echo {random_string(16)} > {FSID_MARKER}) 2>/dev/null; cat {FSID_MARKER}",
+                             alternative=False)
+    fsid = stdout.strip()
+    if err != 0 or not fsid.isalnum():
+        return None
+
+    shared_fs_cache.set(key, fsid)
+    return fsid
+
+
+def get_local_filesystem_id(remote_prefix) -> Optional[str]:
+    # The ID of the destination directory if it is on a filesystem mounted locally as well.
+    try:
+        with open(os.path.join(os.path.expanduser(" ".join(shlex.split(remote_prefix))), FSID_MARKER)) as f:
+            return f.read().strip()
+    except (OSError, ValueError):
+        return None
+
+
+def group_shared_filesystems(src, hosts: List[str], remote_prefix) -> Dict[str, List[str]]:
+    # Groups the hosts writing to the same directory of a shared filesystem. Returns {host to sync: all the hosts
+    # in its group}. Hosts seeing the destination on the same filesystem as the local machine need no sync at all.
+    if not config.get("sync", {}).get("detect_shared_fs", True):
+        return {h: [h] for h in hosts}
+
+    ids = parallel_map_dict(hosts, lambda h: get_filesystem_id(h, remote_prefix))
+    local_id = get_local_filesystem_id(remote_prefix)
+
+    groups = {}
+    for h in hosts:
+        if ids[h] is not None and ids[h] == local_id:
+            continue
+        groups.setdefault(ids[h] or h, []).append(h)
+
+    return {g[0]: g for g in groups.values()}
+
+
+def sync_curr_dir_fanout(hosts, sync_lists, n_seeds: int) -> Dict[str, bool]:
+    res = {h: True for h in hosts}
+
+    for i in range(len(sync_lists[hosts[0]])):
+        # Hosts with the same destination can copy from each other.
+        groups = {}
+        for h in hosts:
+            if res[h]:
+                groups.setdefault(sync_lists[h][i], []).append(h)
+
+        def sync_group(group):
+            (src, dest), group_hosts = group
+            shared = group_shared_filesystems(src, group_hosts, dest)
+            sync_res = fanout_sync(src, list(shared.keys()), dest, n_seeds)
+            return {h: sync_res[rep] for rep, members in shared.items() for h in members}
+
+        for group_res in parallel_map(list(groups.items()), sync_group):
+            for h, ok in group_res.items():
+                if not ok:
+                    src, dest = sync_lists[h][i]
+                    print(f"Failed to copy {src} to {h}:{dest}. Stopping synchronization...")
+                res[h] = ok
+
+    return res
+
+
+def sync_curr_dir_grouped(hosts, prefixes, n_seeds: int) -> Dict[str, bool]:
+    sync_lists = {h: get_sync_list(prefixes[h], "/" if prefixes[h] is not None else None) for h in hosts}
+    if n_seeds and len(hosts) > n_seeds:
+        return sync_curr_dir_fanout(hosts, sync_lists, n_seeds)
+
+    # Each root is synced to a single host per shared filesystem, all the roots of a host together.
+    groups = {}
+    for h in hosts:
+        for root in sync_lists[h]:
+            groups.setdefault(root, []).append(h)
+
+    groups = list(groups.items())
+    roots_to_sync = {h: [] for h in hosts}
+    synced_by = {h: set() for h in hosts}
+    for (root, _), shared in zip(groups, parallel_map(groups, lambda g: group_shared_filesystems(g[0][0], g[1],
+                                                                                                 g[0][1]))):
+        for rep, members in shared.items():
+            roots_to_sync[rep].append(root)
+            for h in members:
+                synced_by[h].add(rep)
+
+    exclude, blacklists = get_sync_filters()
+    host_res = parallel_map_dict([h for h in hosts if roots_to_sync[h]],
+                                 lambda h: sync_many(h, sorted(roots_to_sync[h], key=sync_lists[h].index), exclude,
+                                                     blacklists))
+    return {h: all(host_res[rep] for rep in synced_by[h]) for h in hosts}
+
+
 def sync_curr_dir_multiple(hosts):
     prefixes = get_slurm_target_full_path(hosts)
     prefixes = {k: shlex.quote(os.path.dirname(" ".join(shlex.split(v)))) if v is not None else None for k, v in prefixes.items()}
-    return parallel_map_dict(hosts, lambda h: sync_current_dir(h, prefixes[h], "/" if prefixes[h] is not None else None))
+
+    n_seeds = config.get("sync", {}).get("fanout", 0)
+    if hosts and ((n_seeds and len(hosts) > n_seeds) or config.get("sync", {}).get("detect_shared_fs", True)):
+        res = sync_curr_dir_grouped(hosts, prefixes, n_seeds)
+    else:
+        res = parallel_map_dict(hosts, lambda h: sync_current_dir(h, prefixes[h],
+                                                                  "/" if prefixes[h] is not None else None))
+
+    collect_manifests()
+    return res
 
 
 def copy_local_dir(hosts=None):
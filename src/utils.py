@@ -1,4 +1,5 @@
 import os
+import shlex
 import socket
 import string
 import random
@@ -73,3 +74,16 @@ def hms_string(sec_elapsed):
 def get_command(command: str, default: str) -> str:
     cmd = shutil.which(command)
     return default if cmd is None else command
+
+
+def get_cache_dir(*subdirs: str) -> str:
+    path = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "cluster_tool", *subdirs)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def quote_remote_path(path: str) -> str:
+    # Quotes a path for a remote shell, keeping a leading ~/ unquoted, so that it is still expanded.
+    if path.startswith("~/"):
+        return "~/" + shlex.quote(path[2:]) if path[2:] else "~/"
+    return shlex.quote(path) if path else path
@@ -1,23 +1,24 @@
 from subprocess import run
 from typing import Optional, Tuple, List, Set, Dict, Any
-from .detect_gpus import get_top_gpus
+from .detect_gpus import get_top_gpus, mark_gpus_used
 from .config import config
-from .utils import get_relative_path, get_command
-from .process_tools import remote_run, run_process, run_multiple_hosts
+from .utils import get_relative_path, get_command, quote_remote_path
+from .process_tools import remote_run, run_process
 from .parallel_map import parallel_map
 from .sync import copy_local_dir
 import math
+import json
 import socket
 import tempfile
 import os
-import wandb
-from gql import gql
 from . import slurm
-import yaml
+from . import run_index
 from .payload import send_payload
+from .remote_process import start_detached
 
 
 def get_config_count(file: str) -> Optional[int]:
+    import yaml
     with open(file, "r") as f:
         config = yaml.safe_load(f)
 
@@ -113,7 +114,7 @@ def run_agent_local(sweep_id: str, count: Optional[int], n_runs: Optional[int],
                 else:
                     gcmd = start_prefix + client_command
 
-                _, errcode = remote_run(host, gcmd + " 2>/dev/null")
+                errcode = start_detached(host, gcmd + " 2>/dev/null")
                 if errcode != 0:
                     print(f"Failed to start Multi-GPU W&B client on {host} (command: {cmd}), local rank {i}")
                     if i != 0:
@@ -123,12 +124,13 @@ def run_agent_local(sweep_id: str, count: Optional[int], n_runs: Optional[int],
             cmd = f"{prefix} CUDA_VISIBLE_DEVICES='{','.join(gpus)}' {screen} -d -S " + \
                 f"wandb_sweep_{sweep_id.split('/')[-1]}_gpu_{'_'.join(gpus)}{per_gpu_index} -m {cmd}"
 
-            _, errcode = remote_run(host, cmd + " 2>/dev/null")
+            errcode = start_detached(host, cmd + " 2>/dev/null")
 
             if errcode != 0:
                 print("Failed to start W&B client on %s (command: %s)" % (host, cmd))
 
     parallel_map(all_gpus, start_wandb_client)
+    mark_gpus_used(use_gpus)
 
 
 def run_agent(sweep_id: str, count: Optional[int], n_runs: Optional[int], multi_gpu: Optional[int],
@@ -190,6 +192,7 @@ def sweep(name: str, config_file: str, count: Optional[int], n_gpus: Optional[in
 
 
 def find_entity_and_project(project: str) -> Tuple[str, str]:
+    import wandb
     if "/" in project:
         pieces = project.split("/")
         assert len(pieces) == 2 and min(len(p) for p in pieces) > 1, f"Invalid project specification: {project}"
@@ -198,7 +201,7 @@ def find_entity_and_project(project: str) -> Tuple[str, str]:
         return wandb.InternalApi().viewer()["entity"], project
 
 def cleanup(wandb_relative_path: str):
-    wandb_relative_path = get_relative_path(wandb_relative_path)
+    remote_dir = run_index.get_remote_dir(wandb_relative_path)
     running_sweeps_per_host = {}
 
     def get_running_sweeps(host: str):
@@ -221,27 +224,29 @@ def cleanup(wandb_relative_path: str):
     project = config.get("wandb", {}).get("project")
     entity, project = find_entity_and_project(project)
 
+    import wandb
     api = wandb.Api()
     for sw in all_sweeps:
         runs_per_sweep[sw] = set(r.id for r in api.runs(f"{entity}/{project}", {"sweep": sw}))
 
+    index = run_index.get_run_index({h: remote_dir for h in config["hosts"]})
+
     def do_cleanup(host: str):
         my_runs = set().union(*(runs_per_sweep[s] for s in running_sweeps_per_host[host]))
-        dirs, errcode = remote_run(host, f"ls {wandb_relative_path}")
-        if errcode!=0:
+        dirs = [d for id, runs in index[host].items() if id not in my_runs for d, _, _ in runs]
+        if not dirs:
             return
-        dirs = [d.strip() for d in dirs.split("\n")]
-        dirs = [d for d in dirs if d and d.split("-")[-1] not in my_runs]
-        for d in dirs:
-            d = f"{wandb_relative_path}/'{d}'"
-            out, errcode = remote_run(host, f"rm -r {d}")
-            if errcode!=0:
-                print(f"WARNING: Failed to remove {d} on machine {host}")
+
+        dirs = " ".join(quote_remote_path(f"{remote_dir}/{d}") for d in dirs)
+        out, errcode = remote_run(host, f"rm -r {dirs}")
+        if errcode!=0:
+            print(f"WARNING: Failed to remove some of the old runs on machine {host}")
 
     parallel_map(config["hosts"], do_cleanup)
 
 
-def get_sweep_table(api: wandb.Api, project: str) -> Dict[str, str]:
+def get_sweep_table(api: "wandb.Api", project: str) -> Dict[str, str]:
+    from gql import gql
     QUERY = gql('''       
     query Sweep($project: String!, $entity: String) {
         project(name: $project, entityName: $entity) {
@@ -303,7 +308,14 @@ def get_runs_in_sweep(api, project, sweep_id: Optional[str], filter: Dict = {}):
     return list(api.runs(project, f))
 
 
-def get_run_host(api: wandb.Api, project: str, run_id: str) -> Dict[str, str]:
+def match_host(host: Optional[str]) -> Optional[str]:
+    # W&B reports the short hostname of the machine. Map it to the configured host, if it's unambigous.
+    found = [h for h in config["hosts"] if h.startswith(host)] if host else []
+    return found[0] if len(found) == 1 else None
+
+
+def get_run_host(api: "wandb.Api", project: str, run_id: str) -> Dict[str, str]:
+    from gql import gql
     QUERY = gql('''       
     query Run($projectName: String!, $entityName: String, $runName: String!) {
         project(name: $projectName, entityName: $entityName) {
@@ -321,10 +333,67 @@ def get_run_host(api: wandb.Api, project: str, run_id: str) -> Dict[str, str]:
         'runName': run_id,
     })
 
-    host = response.get("project", {}).get("run", {}).get("host")
+    return match_host(response.get("project", {}).get("run", {}).get("host"))
 
-    found = [h for h in config["hosts"] if h.startswith(host)] if host else []
-    return found[0] if len(found) == 1 else None
+
+def get_run_hosts(api: "wandb.Api", project: str, sweep_id: Optional[str], filter: Dict = {},
+                  per_page: int = 500) -> Dict[str, Optional[str]]:
+    # Same as get_run_host for all runs of the sweep matching the filter, with a single paginated query instead of
+    # one query per run. Returns {run id: host or None}.
+    from gql import gql
+    QUERY = gql('''
+    query Runs($projectName: String!, $entityName: String, $filters: JSONString, $cursor: String, $perPage: Int) {
+        project(name: $projectName, entityName: $entityName) {
+            runs(filters: $filters, after: $cursor, first: $perPage) {
+                edges {
+                    node {
+                        name
+                        host
+                    }
+                }
+                pageInfo {
+                    endCursor
+                    hasNextPage
+                }
+            }
+        }
+    }''')
+
+    entity, project = find_entity_and_project(project)
+    f = {"sweep": sweep_id} if sweep_id else {}
+    f.update(filter)
+
+    res = {}
+    cursor = None
+    while True:
+        response = api.client.execute(QUERY, variable_values={
+            'entityName': entity,
+            'projectName': project,
+            'filters': json.dumps(f),
+            'cursor': cursor,
+            'perPage': per_page,
+        })
+
+        runs = (response.get("project") or {}).get("runs") or {}
+        for edge in runs.get("edges", []):
+            res[edge["node"]["name"]] = match_host(edge["node"]["host"])
+
+        page = runs.get("pageInfo", {})
+        if not page.get("hasNextPage"):
+            return res
+        cursor = page["endCursor"]
+
+
+def find_run_dirs(run_ids_per_host: Dict[str, List[str]]) -> Dict[str, List[Tuple[str, str]]]:
+    # Looks up the directories of many runs in the run index of the hosts. Returns {run id: [(host, dir), ...]}.
+    hosts = [h for h, ids in run_ids_per_host.items() if ids]
+    index = run_index.get_run_index({h: run_index.get_remote_dir("wandb") for h in hosts})
+
+    found = {}
+    for host in hosts:
+        for id, dirs in run_index.find_runs({host: index[host]}, run_ids_per_host[host]).items():
+            found.setdefault(id, []).extend((host, f"./wandb/{d[1]}") for d in dirs)
+    return found
 
 
 def sync_crashed(sweep_name: Optional[str]):
@@ -332,6 +401,7 @@ def sync_crashed(sweep_name: Optional[str]):
     assert wandb_key, "W&B API key is needed for staring a W&B swype"
 
     project = config.get("wandb", {}).get("project")
+    import wandb
     api = wandb.Api()
 
     if sweep_name is not None:
@@ -345,38 +415,30 @@ def sync_crashed(sweep_name: Optional[str]):
             return
 
     relpath = get_relative_path()
-    
-    runs = get_runs_in_sweep(api, project, sweep_name, {"state": "crashed"})
-    print(f"Sweep {sweep_name}: found {len(runs)} crashed runs. Trying to synchronize...")
-    for r in runs:
-        hostname = get_run_host(api, project, r.id)
-        dir = None
-        found = []
-
-        cmd = f"find ./wandb -iname '*{r.id}'"
-        if hostname is None:
-            res = run_multiple_hosts(config["hosts"], cmd)
-            for hn, (res, retcode) in res.items():
-                res = res.strip()
-                if retcode == 0 and res:
-                    found.append((hn, res))
-        else:
-            res, retcode = run_multiple_hosts([hostname], cmd)[hostname]
-            res = res.strip()
-            if retcode == 0 and res:
-                found = [(hostname, res)]
 
-        if len(found) != 1:
-            print(f"WARNING: Failed to identify run {r.id}")
-            continue
-        
-        hostname, dir = found[0]
+    run_hosts = get_run_hosts(api, project, sweep_name, {"state": "crashed"})
+    print(f"Sweep {sweep_name}: found {len(run_hosts)} crashed runs. Trying to synchronize...")
+
+    # Runs with unknown host are searched on all hosts.
+    run_ids_per_host = {h: [] for h in config["hosts"]}
+    for id, host in run_hosts.items():
+        for h in ([host] if host is not None else config["hosts"]):
+            run_ids_per_host[h].append(id)
+
+    found = find_run_dirs(run_ids_per_host)
 
-        if len(dir.split("\n")) != 1:
-            print(f"WARNING: Failed to identify run {r.id}")
+    runs_per_host = {}
+    for id in run_hosts.keys():
+        if len(found.get(id, [])) != 1:
+            print(f"WARNING: Failed to identify run {id}")
             continue
 
-        print(f"Found run {r.id} at {hostname} in dir {dir}. Syncing...")
+        hostname, dir = found[id][0]
+        runs_per_host.setdefault(hostname, []).append((id, dir))
+
+    def sync_run(args: Tuple[str, str, str]) -> bool:
+        hostname, id, dir = args
+        print(f"Found run {id} at {hostname} in dir {dir}. Syncing...")
 
         cd = config.get_command(hostname, "cd")
         wandb_cmd = config.get_command(hostname, "wandb", "~/.local/bin/wandb")
@@ -386,11 +448,20 @@ def sync_crashed(sweep_name: Optional[str]):
         _, errcode = remote_run(hostname, cmd + " 2>/dev/null")
 
         if errcode != 0:
-            print("Sync failed :(")
-            continue
+            print(f"Sync of run {id} failed :(")
+            return False
+        return True
+
+    def sync_host(hostname: str) -> List[bool]:
+        return parallel_map([(hostname, id, dir) for id, dir in runs_per_host[hostname]], sync_run,
+                            max_workers=config.get("wandb", {}).get("sync_parallel", 4))
+
+    results = sum(parallel_map(list(runs_per_host.keys()), sync_host), [])
+    print(f"Synchronized {sum(results)} of {len(run_hosts)} crashed runs.")
 
 
 def remove_artifacts(id: str):
+    import wandb
     api = wandb.Api()
     run = api.run(id)
     artifacts = run.logged_artifacts(per_page=10000)
@@ -400,6 +471,7 @@ def remove_artifacts(id: str):
 
 
 def get_config_count_from_sweepid(sweep_id: str) -> Optional[int]:
+    import wandb
     api = wandb.Api()
     s = api.sweep(sweep_id)
     return get_config_count_from_dict(s.config)
@@ -0,0 +1,242 @@
+import os
+import time
+import errno
+import fnmatch
+import select
+import struct
+import ctypes
+import ctypes.util
+from typing import List, Optional, Dict, Tuple
+from .config import config
+from . import sync
+
+# inotify(7) constants
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_ISDIR = 0x40000000
+IN_Q_OVERFLOW = 0x4000
+EVENT_HEADER = struct.Struct("iIII")
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+             IN_DELETE_SELF
+
+
+def get_watched_dirs(paths: List[str], filter_args: str, exclude: List[str]) -> List[str]:
+    # The directories synced with the current filters, so the excluded and ignored trees (.git, wandb, node_modules,
+    # ...) are not watched. The manifest is shared with the sync itself. If it can't be computed, all directories not
+    # excluded by name are watched.
+    res = []
+    for path in paths:
+        digest, manifest = sync.get_manifest(path, filter_args)
+        base = sync.get_source_base(path)
+        res.append(os.path.normpath(path))
+        if digest is not None:
+            res += [os.path.normpath(os.path.join(base, f)) for f in manifest if f.endswith("/")]
+        else:
+            for root, dirs, _ in os.walk(path):
+                dirs[:] = [d for d in dirs if not is_excluded(d, exclude)]
+                res += [os.path.join(root, d) for d in dirs]
+
+    return sorted(set(res))
+
+
+def is_excluded(name: str, exclude: List[str]) -> bool:
+    return name == ".git" or any(fnmatch.fnmatch(name, e) for e in exclude)
+
+
+class InotifyWatcher:
+    # Watches directory trees with inotify, through libc, so no extra dependency is needed. Linux only.
+
+    def __init__(self, paths: List[str], filter_args: str, exclude: List[str]):
+        self.paths = paths
+        self.filter_args = filter_args
+        self.exclude = exclude
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.dirs: Dict[int, str] = {}
+        try:
+            self.refresh()
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def add_dir(self, path: str):
+        wd = self.libc.inotify_add_watch(self.fd, path.encode(), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            # Removed or replaced since it was listed
+            if err in {errno.ENOENT, errno.ENOTDIR}:
+                return
+            raise OSError(err, f"Failed to watch {path}")
+        self.dirs[wd] = path
+
+    def add_tree(self, path: str):
+        # A new directory. Its content is not in the manifest yet, so it is filtered by name only until the next
+        # refresh.
+        if is_excluded(os.path.basename(path), self.exclude):
+            return
+
+        self.add_dir(path)
+        for root, dirs, _ in os.walk(path):
+            dirs[:] = [d for d in dirs if not is_excluded(d, self.exclude)]
+            for d in dirs:
+                self.add_dir(os.path.join(root, d))
+
+    def refresh(self):
+        # Watches exactly the directories synced, dropping the ones excluded or removed since.
+        wanted = set(get_watched_dirs(self.paths, self.filter_args, self.exclude))
+        for wd, path in list(self.dirs.items()):
+            if path not in wanted:
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.dirs[wd]
+
+        watched = set(self.dirs.values())
+        for path in sorted(wanted - watched):
+            self.add_dir(path)
+
+    def wait(self, timeout: Optional[float]) -> bool:
+        # Returns True if anything changed within timeout seconds.
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+
+        data = os.read(self.fd, 65536)
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, pos)
+            name = data[pos + EVENT_HEADER.size: pos + EVENT_HEADER.size + length].rstrip(b"\0").decode()
+            pos += EVENT_HEADER.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost, so new directories might be missing. Rescan everything.
+                sync.clear_manifests()
+                self.refresh()
+            elif mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and wd in self.dirs:
+                self.add_tree(os.path.join(self.dirs[wd], name))
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollingWatcher:
+    # Fallback for systems without inotify: compares the modification times of the watched directories periodically.
+
+    def __init__(self, paths: List[str], filter_args: str, exclude: List[str]):
+        self.paths = paths
+        self.filter_args = filter_args
+        self.exclude = exclude
+        self.interval = config.get("sync", {}).get("watch_poll_interval", 1)
+        self.snapshot = self.get_snapshot()
+
+    def get_snapshot(self) -> Dict[str, Tuple[int, int]]:
+        res = {}
+        for root in get_watched_dirs(self.paths, self.filter_args, self.exclude):
+            try:
+                names = os.listdir(root)
+            except OSError:
+                continue
+
+            for name in names:
+                try:
+                    st = os.lstat(os.path.join(root, name))
+                except OSError:
+                    continue
+                res[os.path.join(root, name)] = (st.st_size, st.st_mtime_ns)
+        return res
+
+    def refresh(self):
+        self.snapshot = self.get_snapshot()
+
+    def wait(self, timeout: Optional[float]) -> bool:
+        end = None if timeout is None else time.time() + timeout
+        while True:
+            time.sleep(self.interval if end is None else max(min(self.interval, end - time.time()), 0))
+            snapshot = self.get_snapshot()
+            if snapshot != self.snapshot:
+                self.snapshot = snapshot
+                return True
+
+            if end is not None and time.time() >= end:
+                return False
+
+    def close(self):
+        pass
+
+
+def create_watcher(paths: List[str], filter_args: str, exclude: List[str]):
+    try:
+        return InotifyWatcher(paths, filter_args, exclude)
+    except (OSError, AttributeError):
+        # AttributeError: no inotify in libc
+        print("WARNING: inotify is not available. Falling back to polling.")
+        return PollingWatcher(paths, filter_args, exclude)
+
+
+def watch_and_sync(hosts: Optional[List[str]] = None):
+    # Syncs the current directory, then keeps syncing it on every change, until interrupted. Bursts of changes
+    # (e.g. saving many files, git checkout) are waited out before syncing.
+    debounce = config.get("sync", {}).get("watch_debounce", 0.2)
+    if hosts is None:
+        hosts = config.get_all_hosts()
+
+    hosts = sync.filter_hosts_to_sync(hosts)
+    if not hosts:
+        print("No hosts to sync.")
+        return
+
+    exclude, blacklists = sync.get_sync_filters()
+    paths = [src for src, _ in sync.get_sync_list()]
+    filter_args = sync.get_filter_args(exclude, blacklists)
+    watcher = create_watcher(paths, filter_args, exclude)
+    sync.sync_curr_dir_multiple(hosts)
+    print("Watching for changes. Press Ctrl+C to stop.")
+
+    def fall_back(e: OSError):
+        # E.g. out of inotify watches (ENOSPC)
+        nonlocal watcher
+        print(f"WARNING: {e}. Falling back to polling.")
+        watcher.close()
+        watcher = PollingWatcher(paths, filter_args, exclude)
+
+    def wait(timeout: Optional[float]) -> bool:
+        try:
+            return watcher.wait(timeout)
+        except OSError as e:
+            fall_back(e)
+            return True
+
+    try:
+        while True:
+            wait(None)
+            while wait(debounce):
+                pass
+
+            start = time.time()
+            # The manifest is computed once per sync
+            sync.clear_manifests()
+
+            failed = [h for h, ok in sync.sync_curr_dir_multiple(hosts).items() if not ok]
+            if failed:
+                print(f"Failed to copy data to machines {', '.join(failed)}")
+            else:
+                print(f"Synced to {len(hosts)} hosts in {time.time() - start:.2f}s")
+
+            # The directories created or removed since are known from the new manifest.
+            try:
+                watcher.refresh()
+            except OSError as e:
+                fall_back(e)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
@@ -0,0 +1,102 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+# The config and the cache are loaded when the modules are imported.
+work_dir = tempfile.mkdtemp()
+with open(os.path.join(work_dir, "cluster.json"), "w") as f:
+    json.dump({"hosts": ["a", "b"], "remote_agent": False}, f)
+os.chdir(work_dir)
+os.environ["XDG_CACHE_HOME"] = os.path.join(work_dir, "cache")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from src import sync
+
+
+class FakeHosts:
+    # Each host is a local directory. Replaces the listing, hashing and downloading of sync.
+    def __init__(self, root):
+        self.root = root
+
+    def write(self, host, path, content, mtime=1000):
+        path = os.path.join(self.root, host, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+        os.utime(path, (mtime, mtime))
+
+    def list_remote_trees(self, hosts, remote_path):
+        res = {}
+        for h in hosts:
+            base = os.path.join(self.root, h)
+            tree = {}
+            for r, dirs, files in os.walk(base):
+                for name in dirs + files:
+                    p = os.path.join(r, name)
+                    st = os.stat(p)
+                    tree[os.path.relpath(p, base)] = [st.st_size, int(st.st_mtime * 1000), name in dirs]
+            if tree:
+                res[h] = tree
+        return res
+
+    def hash_files(self, host, files, remote_path):
+        res = {}
+        for f in files:
+            with open(os.path.join(self.root, host, f)) as fd:
+                res[f] = str(hash(fd.read()))
+        return res
+
+    def pull_files(self, host, files, dest_folder, remote_path):
+        for f in files:
+            src = os.path.join(self.root, host, f)
+            dest = os.path.join(dest_folder, f)
+            if os.path.isdir(src):
+                os.makedirs(dest, exist_ok=True)
+            else:
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                shutil.copy2(src, dest)
+        return True
+
+
+class TestGatherPrune(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.hosts = FakeHosts(os.path.join(self.tmp, "hosts"))
+        self.dest = os.path.join(self.tmp, "dest")
+        self.patched = {n: getattr(sync, n) for n in ["list_remote_trees", "hash_files", "pull_files"]}
+        for n in self.patched:
+            setattr(sync, n, getattr(self.hosts, n))
+
+    def tearDown(self):
+        for n, f in self.patched.items():
+            setattr(sync, n, f)
+        sync.gather_state.invalidate_prefix("")
+        shutil.rmtree(self.tmp)
+
+    def test_keeps_files_still_on_another_host(self):
+        self.hosts.write("a", "x", "same")
+        self.hosts.write("b", "x", "same")
+        self.hosts.write("a", "y", "only on a")
+        self.hosts.write("b", "z", "only on b")
+        self.assertTrue(sync.gather(self.dest, ["a", "b"], "~/out", mode="on_conflict", prune=True))
+        self.assertTrue(os.path.isfile(os.path.join(self.dest, "x")))
+        self.assertTrue(os.path.isfile(os.path.join(self.dest, "z")))
+
+        # Removed from a, but b still has it unchanged.
+        os.remove(os.path.join(self.hosts.root, "a", "x"))
+        self.assertTrue(sync.gather(self.dest, ["a", "b"], "~/out", mode="on_conflict", prune=True))
+        self.assertTrue(os.path.isfile(os.path.join(self.dest, "x")))
+        self.assertTrue(os.path.isfile(os.path.join(self.dest, "y")))
+
+        # Removed from all the hosts. Hosts that can't be listed keep their files, so b still has some.
+        os.remove(os.path.join(self.hosts.root, "b", "x"))
+        self.assertTrue(sync.gather(self.dest, ["a", "b"], "~/out", mode="on_conflict", prune=True))
+        self.assertFalse(os.path.exists(os.path.join(self.dest, "x")))
+        self.assertTrue(os.path.isfile(os.path.join(self.dest, "y")))
+
+
+if __name__ == "__main__":
+    unittest.main()